@@ -8,218 +8,611 @@ LASSE
 import json
 import os
 import pathlib
+import shutil
 import glob
-import copy
+import hashlib
 import argparse
+import multiprocessing
 import numpy as np
 import networkx as nx
 import tensorflow as tf
 
-def _get_network_data(experiment_path, exp_file, target):
+# experiment context shared with data generation workers
+_WORKER_STATE = {}
+# bump when the generated samples change, invalidating cached shards
+SAMPLE_SHARD_VERSION = 1
+# columnar split format, read by ndt/sync/columnar_data.py
+COLUMNAR_VERSION = 1
+COLUMNAR_FLOW_FEATURES = (
+    "flow_traffic",
+    "flow_loss_packet",
+    "jitter",
+    "flow_packet_size",
+    "flow_propag_delay",
+    "flow_delay_budget",
+    "flow_length",
+)
+COLUMNAR_GRAPH_FEATURES = (
+    ("link_capacity", np.float32),
+    ("link_to_flow", np.int32),
+    ("flow_to_link", np.int32),
+)
+# graph tensors that the VTwin can rebuild from the
+# number of flows and links of a sample (--implicit-graph)
+IMPLICIT_GRAPH_FEATURES = ("link_to_flow", "flow_to_link")
+
+def _build_edge_table(topology):
     """
-    Generate input-output data from data generator data
+    Index the topology links by node pair, keeping the
+    link id, propagation delay and capacity as arrays
+    """
+    edge_index = {}
+    edge_id, edge_delay, edge_capacity = [], [], []
+    for src, dst, key, edge_data in topology.edges(keys=True, data=True):
+        # only the first link between two nodes is used by the paths
+        if key != 0:
+            continue
+        edge_index[(src, dst)] = len(edge_id)
+        if not topology.is_directed():
+            edge_index[(dst, src)] = len(edge_id)
+        edge_id.append(edge_data.get("id", -1))
+        edge_delay.append(edge_data.get("delay"))
+        edge_capacity.append(edge_data.get("capacity"))
+
+    return {
+        "index": edge_index,
+        "id": np.array(edge_id),
+        "delay": np.array(edge_delay, dtype=np.float64),
+        "capacity": np.array(edge_capacity, dtype=np.float64),
+    }
+
+def _build_path_incidence(flow_paths, edge_table):
+    """
+    Build a CSR-like connection to link incidence, where the links
+    crossed by a connection are edge_table rows indices[indptr[row]:indptr[row + 1]]
+    """
+    conn_row = {}
+    indptr, indices = [0], []
+    for conn_id, path in flow_paths.items():
+        conn_row[int(conn_id)] = len(conn_row)
+        indices.extend(edge_table["index"][(str(node[0]), str(node[1]))]
+                       for node in path)
+        indptr.append(len(indices))
+
+    return {
+        "conn_row": conn_row,
+        "indptr": np.array(indptr, dtype=np.int64),
+        "indices": np.array(indices, dtype=np.int64),
+    }
+
+def _file_digest(filepath):
+    """
+    Get the SHA-256 digest of a file content
+    """
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _load_edge_table(topology_file, cache_dir=""):
+    """
+    Load the edge table of a GML topology, reusing the on-disk
+    cache entry of a topology file with the same content
+    """
+    if not cache_dir:
+        return _build_edge_table(nx.read_gml(topology_file))
+
+    cache_file = f"{cache_dir}/topology/{_file_digest(topology_file)}.npz"
+    if os.path.isfile(cache_file):
+        cached = np.load(cache_file)
+        return {
+            "index": {(str(src), str(dst)): int(row) for src, dst, row
+                      in zip(cached["src"], cached["dst"], cached["row"])},
+            "id": cached["id"],
+            "delay": cached["delay"],
+            "capacity": cached["capacity"],
+        }
+
+    edge_table = _build_edge_table(nx.read_gml(topology_file))
+    pathlib.Path(f"{cache_dir}/topology").mkdir(parents=True, exist_ok=True)
+    node_pairs = list(edge_table["index"].keys())
+    # write to a temporary file first, so a partial entry is never read
+    with open(f"{cache_file}.tmp", "wb") as f:
+        np.savez(f,
+                 src=np.array([src for src, _ in node_pairs]),
+                 dst=np.array([dst for _, dst in node_pairs]),
+                 row=np.array(list(edge_table["index"].values()), dtype=np.int64),
+                 id=edge_table["id"],
+                 delay=edge_table["delay"],
+                 capacity=edge_table["capacity"])
+    os.replace(f"{cache_file}.tmp", cache_file)
+
+    return edge_table
+
+def _read_metric_file(exp_file):
+    """
+    Read an ITGDec metric file (-c option) in a single pass,
+    as a float64 array with one row per sample
+    """
+    with open(exp_file, "r", encoding="utf-8") as file:
+        n_columns = len(file.readline().split())
+    if n_columns == 0:
+        return np.empty((0, 5), dtype=np.float64)
+
+    metrics = np.fromfile(exp_file, dtype=np.float64, sep=" ")
+    if metrics.size % n_columns != 0:
+        raise ValueError(f"Malformed metric file: {exp_file}")
+
+    return metrics.reshape(-1, n_columns)
+
+def _load_experiment_context(experiment_path, cache_dir=""):
+    """
+    Parse the experiment metadata and topology once, to be
+    shared by the data generation of every connection file
     """
     with open(f"{experiment_path}/mininet_data.json", "r", encoding="utf-8") as f:
-        flow_paths = json.load(f)["paths"]
-    with open(f"{experiment_path}/mininet_data.json", "r", encoding="utf-8") as f:
-        packet_size = json.load(f)["tr_metadata"]["tr_metadata"]["packet_size"]
+        mininet_data = json.load(f)
     # load topology used in experiment
-    topology = nx.read_gml(f"{experiment_path}/topology.gml")
+    edge_table = _load_edge_table(f"{experiment_path}/topology.gml", cache_dir)
+
+    # index connection paths, so per-flow features are
+    # gathered from arrays instead of per-hop lookups
+    path_incidence = _build_path_incidence(mininet_data["paths"], edge_table)
+    path_length = np.diff(path_incidence["indptr"])
+    path_propag_delay = np.bincount(
+        np.repeat(np.arange(len(path_length)), path_length),
+        weights=edge_table["delay"][path_incidence["indices"]],
+        minlength=len(path_length))
+
+    return {
+        "packet_size": mininet_data["tr_metadata"]["tr_metadata"]["packet_size"],
+        "edge_table": edge_table,
+        "path_incidence": path_incidence,
+        "path_length": path_length,
+        "path_propag_delay": path_propag_delay,
+    }
+
+def _get_network_data(experiment_context, exp_file, target,
+                      batch_size=100, remainder="drop"):
+    """
+    Generate input-output data from data generator data, with
+    batch_size flows per sample. The remainder flows of a connection
+    file are either dropped or kept in a smaller last sample (ragged)
+    """
+    packet_size = experiment_context["packet_size"]
+    edge_table = experiment_context["edge_table"]
+    path_incidence = experiment_context["path_incidence"]
+    path_length = experiment_context["path_length"]
+    path_propag_delay = experiment_context["path_propag_delay"]
 
-    flows = []
     exp_conn_id = int(exp_file.split("/")[-1].split("_")[0])
-    with open(exp_file, "r", encoding="utf-8") as file:
-        for line in file:
-            numbers = line.rstrip("\n").split(" ")  # Extract all numbers
-            if float(numbers[1]) == 0 or float(numbers[4]) < 0:
-                continue
-            flows.append([float(feature) for feature in numbers] + [packet_size] + [exp_conn_id])
-
-        # 1: bandwidth
-        # 4: packet loss
-        # -1: connection ID
-        # -2: packet size
-        # 2: delay
-        # 3: jitter
-        filtered_flow_param = np.take(np.array(flows),
-                                    [1, 4, 3, -2, -1, 2], axis=1)
-        filtered_flow_param[:, 0] = filtered_flow_param[:, 0] # convert to bits/s
+    metrics = _read_metric_file(exp_file)
+    # 1: bandwidth
+    # 4: packet loss
+    metrics = metrics[(metrics[:, 1] != 0) & ~(metrics[:, 4] < 0)]
+
+    filtered_flow_param = np.empty((len(metrics), 6), dtype=np.float64)
+    filtered_flow_param[:, 0] = metrics[:, 1] # bandwidth
+    filtered_flow_param[:, 1] = metrics[:, 4] # packet loss
+    filtered_flow_param[:, 2] = metrics[:, 3] # jitter
+    filtered_flow_param[:, 3] = packet_size
+    filtered_flow_param[:, 4] = exp_conn_id
+    filtered_flow_param[:, 5] = metrics[:, 2] # delay
 
     # removing nan samples from jitter features
     filtered_flow_param = filtered_flow_param[~np.isnan(filtered_flow_param[:, 2])]
 
-    link_to_flow = []
-    # get the links used for each flows
-    for conn_id in filtered_flow_param[:, -2]:
-        link_to_flow.append([topology.get_edge_data(
-                        str(node[0]), str(node[1]))[0].get("id")
-                    for node in flow_paths[str(int(conn_id))]])
-
-    propag_delay = []
-    # get propagation delay for each link
-    for conn_id in filtered_flow_param[:, -2]:
-        propag_delay.append([topology.get_edge_data(
-                        str(node[0]), str(node[1]))[0].get("delay")
-                    for node in flow_paths[str(int(conn_id))]])
+    # map the connection ID of each flow to its incidence row
+    conn_ids, conn_inverse = np.unique(filtered_flow_param[:, -2].astype(int),
+                                       return_inverse=True)
+    flow_rows = np.array([path_incidence["conn_row"][conn_id]
+                          for conn_id in conn_ids], dtype=np.int64)[conn_inverse]
+
     # get propagation delay per-flow
-    propag_delay = np.sum(propag_delay, axis=1) / 10e3 # convert to s
+    propag_delay = path_propag_delay[flow_rows] / 10e3 # convert to s
     delay_budget = np.full(len(propag_delay),
                         np.mean(filtered_flow_param[:, -1]) * 0.4 + np.mean(filtered_flow_param[:, -1]))
+    flow_length = path_length[flow_rows]
 
     # get capacity of used links
-    capacity = [topology.get_edge_data(
-                        str(node[0]), str(node[1]))[0].get("capacity")
-                    for node in flow_paths[str(int(exp_conn_id))]]
-    capacity = np.array(capacity) * 10e3 # convert to kbits/s
-    # get the flows used for each links
-    flow_to_link = []
-    for link_id in range(len(topology.edges())):
-        flow_ids = [(flow_id, 0) for flow_id in range(len(link_to_flow))
-                            if link_id in link_to_flow[flow_id]]
-        if len(flow_ids) == 0:
-            continue
+    exp_row = path_incidence["conn_row"][exp_conn_id]
+    exp_links = path_incidence["indices"][path_incidence["indptr"][exp_row]:
+                                          path_incidence["indptr"][exp_row + 1]]
+    capacity = edge_table["capacity"][exp_links] * 10e3 # convert to kbits/s
 
-        flow_to_link.append(np.array(flow_ids))
-
-    n_flows = len(link_to_flow)
-    aux_link_to_flow = copy.deepcopy(link_to_flow)
-    link_to_flow = []
-    for i in range(n_flows):
-        link_to_flow.append([i for i in range(len(aux_link_to_flow[i]))])
-
-    # reshaping features based on batch size
-    batch_size = 100
-    remainder = len(filtered_flow_param) % batch_size
-    if remainder != 0:
-        filtered_flow_param = filtered_flow_param[:-remainder]
-        propag_delay = propag_delay[:-remainder]
-        delay_budget = delay_budget[:-remainder]
-        link_to_flow = link_to_flow[:-remainder]
-
-    filtered_flow_param = np.reshape(filtered_flow_param,
-                                (int(filtered_flow_param.shape[0]/batch_size),
-                                batch_size,
-                                filtered_flow_param.shape[-1]))
-
-    propag_delay = np.reshape(propag_delay, (int(propag_delay.shape[0]/batch_size),
-                                batch_size))
-
-    delay_budget = np.reshape(delay_budget, (int(delay_budget.shape[0]/batch_size),
-                                batch_size))
-
-    link_to_flow = np.array(link_to_flow)
-    link_to_flow = np.reshape(link_to_flow, (int(link_to_flow.shape[0]/batch_size),
-                                            batch_size, link_to_flow.shape[-1]))
-
-    aux_flow_to_link = np.array(flow_to_link)
-    flow_to_link = []
-    for _ in range(batch_size, aux_flow_to_link.shape[1] + 1, batch_size):
-        flow_to_link.append([[[j, 0] for j in range(batch_size)] * len(capacity)])
-    flow_to_link = np.array(flow_to_link)
-    flow_to_link = flow_to_link.reshape(flow_to_link.shape[0],
-                                        len(capacity),
-                                        batch_size,
-                                        flow_to_link.shape[-1])
-    samples = []
+    # links are indexed by their position on the connection path
+    n_flows = len(flow_rows)
+    link_to_flow = np.broadcast_to(np.arange(len(exp_links)), (n_flows, len(exp_links)))
 
     if target == "delay":
-        for i in range(filtered_flow_param.shape[0]):
-            if any(x == 0 for x in filtered_flow_param[i, :, -1] * 1000):
-                continue
-            sample = (
-                {
-                    # identifier features
-                    "flow_traffic": np.expand_dims(
-                        filtered_flow_param[i, :, 0], axis=1
-                    ),
-                    "flow_loss_packet": np.expand_dims(
-                        filtered_flow_param[i, :, 1], axis=1
-                    ),
-                    "jitter": np.expand_dims(
-                        filtered_flow_param[i, :, 2], axis=1
-                    ),
-                    "flow_packet_size": np.expand_dims(
-                        filtered_flow_param[i, :, 3], axis=1
-                    ),
-                    "flow_propag_delay": np.expand_dims(
-                        propag_delay[i, :], axis=1
-                    ),
-                    "flow_delay_budget": np.expand_dims(
-                        delay_budget[i, :], axis=1
-                    ),
-
-                    "flow_length": np.expand_dims(
-                        [len(flow) for flow in link_to_flow[i]], axis=1),
-                    # link attributes
-                    "link_capacity": np.expand_dims(
-                        capacity, axis=1
-                    ),
-                    # topology attributes
-                    "link_to_flow": np.array(link_to_flow[i]),
-                    "flow_to_link": np.array(flow_to_link[i]),
-                },
-                filtered_flow_param[i, :, -1], # per-flow delay in seconds
-            )
-            samples.append(sample)
-
+        labels = filtered_flow_param[:, -1] # per-flow delay in seconds
     elif target == "jitter":
-        for i in range(filtered_flow_param.shape[0]):
-            if any(x == 0 for x in filtered_flow_param[i, :, 2] * 1000):
-                continue
-            sample = (
-                {
-                    # identifier features
-                    "flow_traffic": np.expand_dims(
-                        filtered_flow_param[i, :, 0], axis=1
-                    ),
-                    "flow_loss_packet": np.expand_dims(
-                        filtered_flow_param[i, :, 1], axis=1
-                    ),
-                    "jitter": np.expand_dims(
-                        filtered_flow_param[i, :, 2], axis=1
-                    ),
-                    "flow_packet_size": np.expand_dims(
-                        filtered_flow_param[i, :, 3], axis=1
-                    ),
-                    "flow_propag_delay": np.expand_dims(
-                        propag_delay[i, :], axis=1
-                    ),
-                    "flow_delay_budget": np.expand_dims(
-                        delay_budget[i, :], axis=1
-                    ),
-
-                    "flow_length": np.expand_dims(
-                        [len(flow) for flow in link_to_flow[i]], axis=1),
-                    # link attributes
-                    "link_capacity": np.expand_dims(
-                        capacity, axis=1
-                    ),
-                    # topology attributes
-                    "link_to_flow": np.array(link_to_flow[i]),
-                    "flow_to_link": np.array(flow_to_link[i]),
-                },
-                filtered_flow_param[i, :, 2] * 1000, # per-flow jitter in ms
-            )
-            samples.append(sample)
-
+        labels = filtered_flow_param[:, 2] * 1000 # per-flow jitter in ms
     else:
         raise ValueError("Choose a valid target QoS metric!")
 
+    # splitting flows in batches based on batch size
+    if remainder == "drop":
+        # the remainder flows are dropped, and so is any
+        # batch with a zero label
+        batch_starts = np.arange(0, n_flows - n_flows % batch_size, batch_size)
+    elif remainder == "ragged":
+        # only the flows with a zero label are dropped, and
+        # the remainder flows are kept as a smaller last batch
+        valid_flows = labels != 0
+        filtered_flow_param = filtered_flow_param[valid_flows]
+        labels = labels[valid_flows]
+        propag_delay = propag_delay[valid_flows]
+        delay_budget = delay_budget[valid_flows]
+        flow_length = flow_length[valid_flows]
+        link_to_flow = link_to_flow[valid_flows]
+        batch_starts = np.arange(0, len(labels), batch_size)
+    else:
+        raise ValueError("Choose a valid flow remainder mode!")
+
+    samples = []
+    for start in batch_starts:
+        end = start + batch_size
+        if np.any(labels[start:end] == 0):
+            continue
+        n_batch_flows = len(labels[start:end])
+        # every link of the connection path is crossed by all flows in a batch
+        batch_flow_ids = np.stack([np.arange(n_batch_flows),
+                                   np.zeros(n_batch_flows, dtype=np.int64)], axis=1)
+        sample = (
+            {
+                # identifier features
+                "flow_traffic": np.expand_dims(
+                    filtered_flow_param[start:end, 0], axis=1
+                ),
+                "flow_loss_packet": np.expand_dims(
+                    filtered_flow_param[start:end, 1], axis=1
+                ),
+                "jitter": np.expand_dims(
+                    filtered_flow_param[start:end, 2], axis=1
+                ),
+                "flow_packet_size": np.expand_dims(
+                    filtered_flow_param[start:end, 3], axis=1
+                ),
+                "flow_propag_delay": np.expand_dims(
+                    propag_delay[start:end], axis=1
+                ),
+                "flow_delay_budget": np.expand_dims(
+                    delay_budget[start:end], axis=1
+                ),
+
+                "flow_length": np.expand_dims(
+                    flow_length[start:end], axis=1
+                ),
+                # link attributes
+                "link_capacity": np.expand_dims(
+                    capacity, axis=1
+                ),
+                # topology attributes
+                "link_to_flow": np.array(link_to_flow[start:end]),
+                "flow_to_link": np.tile(batch_flow_ids, (len(capacity), 1, 1)),
+            },
+            labels[start:end],
+        )
+        samples.append(sample)
+
     return samples
 
-def _generator(experiment_path, target):
-    experiment_path = experiment_path.decode("utf-8")
-    target = target.decode("utf-8")
-    for exp_file in glob.glob(f"{experiment_path}/*_metric_results.txt"):
+def _init_worker(experiment_context, target, batch_size, remainder):
+    """
+    Share the experiment context with a data generation worker
+    """
+    _WORKER_STATE["experiment_context"] = experiment_context
+    _WORKER_STATE["target"] = target
+    _WORKER_STATE["batch_size"] = batch_size
+    _WORKER_STATE["remainder"] = remainder
+
+def _get_worker_network_data(exp_file):
+    """
+    Generate input-output data of a connection file in a worker
+    """
+    return _get_network_data(_WORKER_STATE["experiment_context"],
+                             exp_file, _WORKER_STATE["target"],
+                             _WORKER_STATE["batch_size"], _WORKER_STATE["remainder"])
+
+def _iter_network_data(experiment_context, exp_files, target, workers,
+                       batch_size=100, remainder="drop"):
+    """
+    Generate the input-output data of each connection file, in order
+    """
+    if workers <= 1:
+        for exp_file in exp_files:
+            yield _get_network_data(experiment_context, exp_file, target,
+                                    batch_size, remainder)
+        return
+
+    # parse connection files in parallel, keeping the serial sample order.
+    # spawn is used since forking a process with TensorFlow running is unsafe
+    with multiprocessing.get_context("spawn").Pool(
+            workers,
+            initializer=_init_worker,
+            initargs=(experiment_context, target, batch_size, remainder)) as pool:
+        yield from pool.imap(_get_worker_network_data, exp_files)
+
+def _input_digest(filepath, old_inputs, new_inputs):
+    """
+    Get the digest of an experiment input file, reusing the manifest
+    entry when the file size and modification time are unchanged
+    """
+    stat = os.stat(filepath)
+    name = os.path.basename(filepath)
+    entry = old_inputs.get(name)
+    if (entry is None or entry["size"] != stat.st_size
+            or entry["mtime"] != stat.st_mtime_ns):
+        entry = {"size": stat.st_size,
+                 "mtime": stat.st_mtime_ns,
+                 "digest": _file_digest(filepath)}
+    new_inputs[name] = entry
+    return entry["digest"]
+
+def _sample_shard_key(experiment_context, exp_file, metric_digest, target,
+                      batch_size, remainder):
+    """
+    Content address of the samples of a connection file, covering the
+    metric file and the experiment data used by its connection
+    """
+    edge_table = experiment_context["edge_table"]
+    path_incidence = experiment_context["path_incidence"]
+    exp_conn_id = int(exp_file.split("/")[-1].split("_")[0])
+    exp_row = path_incidence["conn_row"][exp_conn_id]
+    exp_links = path_incidence["indices"][path_incidence["indptr"][exp_row]:
+                                          path_incidence["indptr"][exp_row + 1]]
+
+    digest = hashlib.sha256()
+    digest.update(f"{SAMPLE_SHARD_VERSION}:{target}:{batch_size}:{remainder}:{metric_digest}:"
+                  f"{experiment_context['packet_size']}:{exp_conn_id}".encode())
+    digest.update(edge_table["delay"][exp_links].tobytes())
+    digest.update(edge_table["capacity"][exp_links].tobytes())
+    return digest.hexdigest()
+
+def _update_manifest(experiment_path, experiment_context, exp_files, target, cache_dir,
+                     batch_size=100, remainder="drop"):
+    """
+    Hash the experiment inputs and assign a cached sample shard to each
+    connection file, storing both in the experiment manifest
+    """
+    manifest_id = hashlib.sha256(os.path.abspath(experiment_path).encode()).hexdigest()
+    manifest_file = f"{cache_dir}/manifests/{manifest_id[:16]}_{target}.json"
+    manifest = {"inputs": {}, "saved": {}}
+    if os.path.isfile(manifest_file):
+        with open(manifest_file, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+
+    inputs = {}
+    _input_digest(f"{experiment_path}/mininet_data.json", manifest["inputs"], inputs)
+    _input_digest(f"{experiment_path}/topology.gml", manifest["inputs"], inputs)
+    shards = {}
+    for exp_file in exp_files:
+        metric_digest = _input_digest(exp_file, manifest["inputs"], inputs)
+        shards[os.path.basename(exp_file)] = _sample_shard_key(
+            experiment_context, exp_file, metric_digest, target, batch_size, remainder)
+
+    # the dataset is identified by its shards, in the sample order
+    dataset_digest = hashlib.sha256(
+        ":".join(shards[os.path.basename(exp_file)] for exp_file in exp_files).encode())
+    manifest.update({
+        "experiment_path": os.path.abspath(experiment_path),
+        "inputs": inputs,
+        "shards": shards,
+        "dataset_digest": dataset_digest.hexdigest(),
+    })
+
+    pathlib.Path(f"{cache_dir}/manifests").mkdir(parents=True, exist_ok=True)
+    with open(manifest_file, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=4)
+
+    return manifest, manifest_file
+
+def _prune_cache(cache_dir):
+    """
+    Remove the cached sample shards and topologies that no manifest
+    refers to anymore, e.g. after their input files changed
+    """
+    sample_shards, topologies = set(), set()
+    for manifest_file in glob.glob(f"{cache_dir}/manifests/*.json"):
+        with open(manifest_file, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        sample_shards.update(manifest.get("shards", {}).values())
+        if "topology.gml" in manifest.get("inputs", {}):
+            topologies.add(manifest["inputs"]["topology.gml"]["digest"])
+
+    for cache_subdir, keys in (("samples", sample_shards), ("topology", topologies)):
+        for cache_file in glob.glob(f"{cache_dir}/{cache_subdir}/*.npz*"):
+            if os.path.basename(cache_file).split(".")[0] not in keys:
+                os.remove(cache_file)
+
+def _save_sample_shard(shard_file, samples):
+    """
+    Store the samples of a connection file, stacking each feature
+    when all the samples have the same number of flows
+    """
+    shard = {"n_samples": np.array(len(samples))}
+    if len(set(len(sample[1]) for sample in samples)) == 1:
+        for feature in samples[0][0]:
+            shard[feature] = np.stack([sample[0][feature] for sample in samples])
+        shard["label"] = np.stack([sample[1] for sample in samples])
+    else:
+        # ragged samples are stored one by one
+        for i, (features, label) in enumerate(samples):
+            for feature, value in features.items():
+                shard[f"{i}/{feature}"] = value
+            shard[f"{i}/label"] = label
+
+    # write to a temporary file first, so a partial shard is never read
+    with open(f"{shard_file}.tmp", "wb") as f:
+        np.savez(f, **shard)
+    os.replace(f"{shard_file}.tmp", shard_file)
+
+def _load_sample_shard(shard_file):
+    """
+    Load the samples of a connection file stored by _save_sample_shard
+    """
+    with np.load(shard_file) as shard:
+        n_samples = int(shard["n_samples"])
+        if n_samples == 0 or "label" in shard.files:
+            features = {feature: shard[feature] for feature in shard.files
+                        if feature not in ("n_samples", "label")}
+            labels = shard["label"] if n_samples != 0 else None
+            return [({feature: values[i] for feature, values in features.items()}, labels[i])
+                    for i in range(n_samples)]
+
+        samples = [({}, None) for _ in range(n_samples)]
+        for key in shard.files:
+            if key == "n_samples":
+                continue
+            i, feature = key.split("/")
+            if feature == "label":
+                samples[int(i)] = (samples[int(i)][0], shard[key])
+            else:
+                samples[int(i)][0][feature] = shard[key]
+        return samples
+
+def _iter_samples(experiment_path, target, cache_dir, workers,
+                  batch_size=100, remainder="drop", shards=None):
+    """
+    Generate the input-output samples of an experiment, in order, with
+    the sample shards of its connection files assigned by _update_manifest,
+    computed here if not given
+    """
+    experiment_context = _load_experiment_context(experiment_path, cache_dir)
+    exp_files = glob.glob(f"{experiment_path}/*_metric_results.txt")
+    if not cache_dir:
+        for exp_file, samples in zip(exp_files, _iter_network_data(
+                experiment_context, exp_files, target, workers,
+                batch_size, remainder)):
+            print(exp_file)
+            for i, _ in enumerate(samples):
+                yield samples[i]
+        return
+
+    # only connection files without a cached sample shard are processed
+    if shards is None:
+        shards = _update_manifest(experiment_path, experiment_context,
+                                  exp_files, target, cache_dir,
+                                  batch_size, remainder)[0]["shards"]
+    pathlib.Path(f"{cache_dir}/samples").mkdir(parents=True, exist_ok=True)
+    shard_files = [f"{cache_dir}/samples/{shards[os.path.basename(exp_file)]}.npz"
+                   for exp_file in exp_files]
+    is_cached = [os.path.isfile(shard_file) for shard_file in shard_files]
+    computed_samples = _iter_network_data(
+        experiment_context,
+        [exp_file for exp_file, cached in zip(exp_files, is_cached) if not cached],
+        target,
+        workers,
+        batch_size,
+        remainder)
+
+    for exp_file, shard_file, cached in zip(exp_files, shard_files, is_cached):
         print(exp_file)
-        samples = _get_network_data(experiment_path, exp_file, target)
+        if cached:
+            samples = _load_sample_shard(shard_file)
+        else:
+            samples = next(computed_samples)
+            _save_sample_shard(shard_file, samples)
         for i, _ in enumerate(samples):
             yield samples[i]
+    computed_samples.close()
 
+def _drop_implicit_graph(sample):
+    """
+    Drop the graph tensors that are rebuilt by the VTwin, since they
+    only depend on the number of flows and links of the sample
+    """
+    features, label = sample
+    return ({feature: value for feature, value in features.items()
+             if feature not in IMPLICIT_GRAPH_FEATURES}, label)
+
+def _generator(experiment_path, target, cache_dir, workers, implicit_graph,
+               batch_size, remainder, shards):
+    for sample in _iter_samples(experiment_path.decode("utf-8"),
+                                target.decode("utf-8"),
+                                cache_dir.decode("utf-8"),
+                                workers,
+                                batch_size,
+                                remainder.decode("utf-8"),
+                                json.loads(shards.decode("utf-8"))):
+        yield _drop_implicit_graph(sample) if implicit_graph else sample
 
-def generate_tf_data(experiment_path, target):
+class _ColumnarWriter:
+    """
+    Streaming writer of a dataset split in columnar format. Per-flow
+    features and labels are appended to contiguous float32 files, and
+    the graph tensors (link_capacity, link_to_flow and flow_to_link),
+    shared by the samples of a connection path, are stored only once
     """
-    Convert numpy data to tensorflow data structure
+    def __init__(self, path, implicit_graph=False):
+        self.path = path
+        self.graph_features = [(feature, dtype) for feature, dtype in COLUMNAR_GRAPH_FEATURES
+                               if not implicit_graph or feature not in IMPLICIT_GRAPH_FEATURES]
+        # replace a previously saved split
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        pathlib.Path(path).mkdir(parents=True, exist_ok=True)
+        self.columns = {column: open(f"{path}/{column}.f32", "wb")
+                        for column in COLUMNAR_FLOW_FEATURES + ("label",)}
+        self.graph_ids = {}
+        self.graphs = {}
+        self.flow_offsets = [0]
+        self.sample_graph = []
+        self.sample_fold = []
+
+    def write(self, sample, fold):
+        """
+        Append a sample of the given fold to the split
+        """
+        features, label = sample
+        for feature in COLUMNAR_FLOW_FEATURES:
+            self.columns[feature].write(
+                np.ascontiguousarray(features[feature], dtype=np.float32).tobytes())
+        self.columns["label"].write(np.ascontiguousarray(label, dtype=np.float32).tobytes())
+
+        graph = tuple(np.ascontiguousarray(features[feature], dtype=dtype)
+                      for feature, dtype in self.graph_features)
+        graph_key = b"".join(str(array.shape).encode() + array.tobytes() for array in graph)
+        if graph_key not in self.graph_ids:
+            graph_id = len(self.graph_ids)
+            self.graph_ids[graph_key] = graph_id
+            for (feature, _), array in zip(self.graph_features, graph):
+                self.graphs[f"{graph_id}/{feature}"] = array
+
+        self.flow_offsets.append(self.flow_offsets[-1] + len(label))
+        self.sample_graph.append(self.graph_ids[graph_key])
+        self.sample_fold.append(fold)
+
+    def close(self):
+        """
+        Flush the columns and write the split index and metadata
+        """
+        for column in self.columns.values():
+            column.close()
+        np.savez(f"{self.path}/graphs.npz", **self.graphs)
+        np.savez(f"{self.path}/index.npz",
+                 flow_offsets=np.array(self.flow_offsets, dtype=np.int64),
+                 sample_graph=np.array(self.sample_graph, dtype=np.int32),
+                 sample_fold=np.array(self.sample_fold, dtype=np.int32))
+        # the metadata is written last, marking the split as complete
+        with open(f"{self.path}/metadata.json", "w", encoding="utf-8") as f:
+            json.dump({
+                "format": "columnar",
+                "version": COLUMNAR_VERSION,
+                "n_samples": len(self.sample_graph),
+                "n_flows": self.flow_offsets[-1],
+                "n_graphs": len(self.graph_ids),
+                "flow_features": list(COLUMNAR_FLOW_FEATURES),
+                "graph_features": [feature for feature, _ in self.graph_features],
+            }, f, indent=4)
+
+
+def generate_tf_data(experiment_path, target, cache_dir="", workers=1, implicit_graph=False,
+                     batch_size=100, remainder="drop", shards=None):
+    """
+    Convert numpy data to tensorflow data structure, see _iter_samples
     """
     signature = (
         {
@@ -236,10 +629,13 @@ def generate_tf_data(experiment_path, target):
         },
         tf.TensorSpec(shape=None, dtype=tf.float32),
     )
+    if implicit_graph:
+        signature = _drop_implicit_graph(signature)
 
     ds = tf.data.Dataset.from_generator(
         _generator,
-        args=[experiment_path, target],
+        args=[experiment_path, target, cache_dir or "", workers, implicit_graph,
+              batch_size, remainder, json.dumps(shards)],
         output_signature=signature,
     )
 
@@ -247,6 +643,33 @@ def generate_tf_data(experiment_path, target):
 
     return ds
 
+def _load_folds(data_path, folds):
+    """
+    Load the samples of the given folds, in fold order, from a
+    dataset saved with one shard per fold, reading only their shards
+    """
+    folds = tf.constant(folds, dtype=tf.int64)
+
+    def reader_func(datasets):
+        return datasets.enumerate().filter(
+            lambda fold, _: tf.reduce_any(tf.equal(fold, folds))
+        ).flat_map(lambda _, fold_ds: fold_ds)
+
+    return tf.data.Dataset.load(data_path, compression="GZIP", reader_func=reader_func)
+
+def _fold_shard_func():
+    """
+    Shard function of tf.data.Dataset.save() sending each sample to the
+    shard of its fold, sample index mod N_FOLDS, from a counter of the
+    saved samples, since the save runs over the samples in order
+    """
+    sample_idx = tf.Variable(0, dtype=tf.int64, trainable=False)
+
+    def shard_func(features, label):
+        return (sample_idx.assign_add(1) - 1) % N_FOLDS
+
+    return shard_func
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Run the dataset generator")
     parser.add_argument("--input-dir",
@@ -265,22 +688,69 @@ if __name__ == "__main__":
                         type=str,
                         required=True,
                         help="Name of the topology used")
+    parser.add_argument("--cache-dir",
+                        type=str,
+                        default=None,
+                        help="Path to cache parsed topologies, input hashes and"
+                             " samples, disabled by default")
+    parser.add_argument("--workers",
+                        type=int,
+                        default=1,
+                        help="Number of processes parsing connection files")
+    parser.add_argument("--format",
+                        type=str,
+                        default="snapshot",
+                        choices=["snapshot", "columnar"],
+                        help="Storage format of the dataset splits")
+    parser.add_argument("--implicit-graph",
+                        action="store_true",
+                        help="Do not store link_to_flow and flow_to_link in each sample,"
+                             " they are rebuilt by the VTwin")
+    parser.add_argument("--batch-size",
+                        type=int,
+                        default=100,
+                        help="Number of flows per sample")
+    parser.add_argument("--remainder",
+                        type=str,
+                        default="drop",
+                        choices=["drop", "ragged"],
+                        help="Drop the flows that do not fill a sample, or keep"
+                             " them in a smaller last sample (ragged)")
     args = parser.parse_args()
 
-    # saving tensorflow input-output data
-    tf.data.Dataset.save(
-    generate_tf_data(
-        args.input_dir,
-        args.target
-    ),
-    f"labeled_database/{args.target}_database/{args.topology_name}/{args.name}/all",
-        compression="GZIP",
-    )
     N_FOLDS = 20 # used to divide trainig and testing datasets
+    VAL_IDX = 1
+    TEST_IDX = 0
 
-    ds = tf.data.Dataset.load(f"labeled_database/{args.target}_database/{args.topology_name}/{args.name}/all",
-                                compression="GZIP")
-    ds_split = [ds.shard(N_FOLDS, ii) for ii in range(N_FOLDS)]
+    ALL_DATA_PATH = f"labeled_database/{args.target}_database/{args.topology_name}/{args.name}/all"
+    TRAINING_DATA_PATH = f"labeled_database/{args.target}_database/{args.topology_name}/{args.name}_cv/training"
+    VALIDATION_DATA_PATH = f"labeled_database/{args.target}_database/{args.topology_name}/{args.name}_cv/validation"
+    TESTING_DATA_PATH = f"traffic_database/{args.target}_database/{args.topology_name}/{args.name}_cv/testing"
+    SPLIT_PATHS = [TRAINING_DATA_PATH, VALIDATION_DATA_PATH, TESTING_DATA_PATH]
+    manifest = None
+    shards = None
+    if args.cache_dir:
+        # skip the regeneration when no experiment input has changed
+        manifest, manifest_file = _update_manifest(
+            args.input_dir,
+            _load_experiment_context(args.input_dir, args.cache_dir),
+            glob.glob(f"{args.input_dir}/*_metric_results.txt"),
+            args.target,
+            args.cache_dir,
+            args.batch_size,
+            args.remainder)
+        saved_stamp = f"{args.format}:{args.implicit_graph}:{manifest['dataset_digest']}"
+        if all(manifest["saved"].get(split_path) == saved_stamp and os.path.isdir(split_path)
+               for split_path in SPLIT_PATHS):
+            print("Dataset is up to date, nothing to regenerate")
+            raise SystemExit(0)
+        # an interrupted regeneration must not leave the splits marked as saved
+        for split_path in SPLIT_PATHS:
+            manifest["saved"].pop(split_path, None)
+        with open(manifest_file, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=4)
+        # the samples reuse the shards assigned while checking the inputs
+        shards = manifest["shards"]
 
     LABELED_DATA_PATH = f"labeled_database/{args.target}_database/"
     if os.path.isfile(LABELED_DATA_PATH):
@@ -294,26 +764,63 @@ if __name__ == "__main__":
     else:
         pathlib.Path(TRAFFIC_DATA_PATH).mkdir(parents=True, exist_ok=True)
 
-
-    VAL_IDX = 1
-    TEST_IDX = 0
-    # Split dataset into train and validation
-    ds_val = ds_split[VAL_IDX]
-    ds_test = ds_split[TEST_IDX]
-
-    tr_splits = [jj for jj in range(N_FOLDS)]
-
-    ds_train = ds_split[2]
-    for jj in tr_splits[3:]:
-        ds_train = ds_train.concatenate(ds_split[jj])
-
-    # Save datasets
-    tf.data.Dataset.save(
-        ds_train, f"labeled_database/{args.target}_database/{args.topology_name}/{args.name}_cv/training",
-        compression="GZIP")
-    tf.data.Dataset.save(
-        ds_val, f"labeled_database/{args.target}_database/{args.topology_name}/{args.name}_cv/validation",
-        compression="GZIP")
-    tf.data.Dataset.save(
-        ds_test, f"traffic_database/{args.target}_database/{args.topology_name}/{args.name}_cv/testing",
-        compression="GZIP")
\ No newline at end of file
+    if args.format == "columnar":
+        # route each sample to its split in a single pass
+        split_writers = {
+            TEST_IDX: _ColumnarWriter(TESTING_DATA_PATH, args.implicit_graph),
+            VAL_IDX: _ColumnarWriter(VALIDATION_DATA_PATH, args.implicit_graph),
+        }
+        training_writer = _ColumnarWriter(TRAINING_DATA_PATH, args.implicit_graph)
+        for sample_idx, sample in enumerate(_iter_samples(args.input_dir,
+                                                          args.target,
+                                                          args.cache_dir,
+                                                          args.workers,
+                                                          args.batch_size,
+                                                          args.remainder,
+                                                          shards)):
+            fold = sample_idx % N_FOLDS
+            split_writers.get(fold, training_writer).write(sample, fold)
+        for writer in list(split_writers.values()) + [training_writer]:
+            writer.close()
+    else:
+        # saving tensorflow input-output data in a single pass, with the
+        # samples of each fold (sample index mod N_FOLDS) in their own shard;
+        # the index is counted while saving and not stored, so the samples keep
+        # their (features, label) structure, and interleaving the N_FOLDS shards
+        # one sample at a time reads them back in their generation order
+        tf.data.Dataset.save(
+        generate_tf_data(
+            args.input_dir,
+            args.target,
+            args.cache_dir,
+            args.workers,
+            args.implicit_graph,
+            args.batch_size,
+            args.remainder,
+            shards
+        ),
+        ALL_DATA_PATH,
+            compression="GZIP",
+            shard_func=_fold_shard_func(),
+        )
+
+        # Split dataset into train and validation, each split
+        # reading only the shards of its folds
+        ds_val = _load_folds(ALL_DATA_PATH, [VAL_IDX])
+        ds_test = _load_folds(ALL_DATA_PATH, [TEST_IDX])
+
+        tr_splits = [jj for jj in range(N_FOLDS) if jj not in (VAL_IDX, TEST_IDX)]
+
+        ds_train = _load_folds(ALL_DATA_PATH, tr_splits)
+
+        # Save datasets
+        tf.data.Dataset.save(ds_train, TRAINING_DATA_PATH, compression="GZIP")
+        tf.data.Dataset.save(ds_val, VALIDATION_DATA_PATH, compression="GZIP")
+        tf.data.Dataset.save(ds_test, TESTING_DATA_PATH, compression="GZIP")
+
+    if manifest is not None:
+        for split_path in SPLIT_PATHS:
+            manifest["saved"][split_path] = saved_stamp
+        with open(manifest_file, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=4)
+        _prune_cache(args.cache_dir)
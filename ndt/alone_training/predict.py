@@ -2,7 +2,7 @@ import numpy as np
 from matplotlib import pyplot as plt
 import tensorflow as tf
 import std_delay_model
-from std_train import get_mean_std_dict
+from std_train import get_mean_std_dict, load_mean_std_scores
 
 
 root_data_dir = '../ndt/weights/model_version_2'
@@ -18,22 +18,24 @@ trained_model.compile(
 )
 
 dataset_path = '/home/claudio/papers/2025-cn-netwins/traffic_generator/ditg/labeled_data/experiment_204_cv'
-trained_model.set_mean_std_scores(
-    get_mean_std_dict(
+# the scores are stored next to the weights by train_and_evaluate
+mean_std_scores = load_mean_std_scores(f'{root_data_dir}/final_weight')
+if mean_std_scores is None:
+    mean_std_scores = get_mean_std_dict(
         tf.data.Dataset.load(f'{dataset_path}/training',
         compression='GZIP'),
         trained_model.mean_std_scores_fields,
     )
-)
+trained_model.set_mean_std_scores(mean_std_scores)
 
 stream_data = tf.data.Dataset.load(f'{dataset_path}/testing', compression="GZIP")
 
 aes = []
-for _, (sample_features, labels) in enumerate(stream_data):
-    stream_data_sample = (sample_features, labels)
-    # obtain the prediction as numpy array, and flatten
-    predicted_delay = trained_model(stream_data_sample[0]).numpy().reshape((-1,))
-    ground_truth_delay = stream_data_sample[1].numpy()
+stream_data = list(stream_data)
+# samples of the same connection are predicted together, in one forward pass
+predictions = trained_model.predict_samples([sample_features for sample_features, _ in stream_data])
+for (_, labels), predicted_delay in zip(stream_data, predictions):
+    ground_truth_delay = labels.numpy()
     #mape = np.mean(np.abs((ground_truth_delay - predicted_delay)/ground_truth_delay)) * 100
     ae = np.abs((ground_truth_delay - predicted_delay))
     aes.extend(ae)
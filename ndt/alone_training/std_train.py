@@ -89,28 +89,48 @@ def get_mean_std_dict(
         The first value is the min value of the parameter, and the second is 1 / (max - min).
     """
 
-    # Use first sample to get the shape of the tensors
-    iter_ds = iter(ds)
-    sample, label = next(iter_ds)
-    params_lists = {param: sample[param].numpy() for param in params}
-    if include_y:
-        params_lists[include_y] = label.numpy()
-
-    # Include the rest of the samples
-    for sample, label in iter_ds:
-        for param in params:
-            params_lists[param] = np.concatenate(
-                (params_lists[param], sample[param].numpy()), axis=0
-            )
+    def get_values(sample, label):
+        values = {param: sample[param] for param in params}
         if include_y:
-            params_lists[include_y] = np.concatenate(
-                (params_lists[include_y], label.numpy()), axis=0
+            values[include_y] = label
+        return values
+
+    def merge_stats(stats, values):
+        # Merge the count, mean and sum of squared deviations of a sample
+        # into the running ones (parallel variance algorithm)
+        new_stats = dict()
+        for param, (count, mean, m2) in stats.items():
+            value = tf.cast(values[param], tf.float64)
+            sample_count = tf.cast(tf.shape(value)[0], tf.float64)
+            sample_mean = tf.math.divide_no_nan(tf.reduce_sum(value, axis=0), sample_count)
+            sample_m2 = tf.reduce_sum(tf.square(value - sample_mean), axis=0)
+            total = count + sample_count
+            delta = sample_mean - mean
+            new_stats[param] = (
+                total,
+                mean + tf.math.divide_no_nan(delta * sample_count, total),
+                m2 + sample_m2 + tf.math.divide_no_nan(delta**2 * count * sample_count, total),
             )
+        return new_stats
+
+    # Use first sample to get the shape of the tensors
+    first_values = get_values(*next(iter(ds)))
+    initial_stats = {
+        param: (
+            tf.constant(0, dtype=tf.float64),
+            tf.zeros(value.shape[1:], dtype=tf.float64),
+            tf.zeros(value.shape[1:], dtype=tf.float64),
+        )
+        for param, value in first_values.items()
+    }
+
+    # Single streaming pass over the dataset, with constant memory
+    stats = ds.map(get_values).reduce(initial_stats, merge_stats)
 
     scores = dict()
-    for param, param_list in params_lists.items():
-        mean_val = np.mean(param_list, axis=0)
-        std_val = np.std(param_list, axis=0)
+    for param, (count, mean, m2) in stats.items():
+        mean_val = mean.numpy().astype(np.float32)
+        std_val = np.sqrt(m2.numpy() / count.numpy()).astype(np.float32)
 
         if all(std_val) == 0:
             scores[param] = [mean_val, std_val]
@@ -120,6 +140,63 @@ def get_mean_std_dict(
     return scores
 
 
+def save_mean_std_scores(
+    scores: Dict[str, Tuple[np.ndarray, np.ndarray]], weights_file: str
+) -> None:
+    """Store the z-score normalization scores of a model in a sidecar
+    file next to its weights, "{weights_file}.mean_std.npz"
+
+    Parameters
+    ----------
+    scores : Dict[str, Tuple[np.ndarray, np.ndarray]]
+        Dictionary containing the values needed for the z-score normalization,
+        see get_mean_std_dict().
+
+    weights_file : str
+        Path of the model weights, as given to model.load_weights().
+    """
+    sidecar = {}
+    for param, (mean_val, scale_val) in scores.items():
+        sidecar[f"{param}/mean"] = mean_val
+        sidecar[f"{param}/scale"] = scale_val
+
+    os.makedirs(os.path.dirname(weights_file) or ".", exist_ok=True)
+    # write to a temporary file first, so a partial sidecar is never read
+    with open(f"{weights_file}.mean_std.npz.tmp", "wb") as f:
+        np.savez(f, **sidecar)
+    os.replace(f"{weights_file}.mean_std.npz.tmp", f"{weights_file}.mean_std.npz")
+
+
+def load_mean_std_scores(
+    weights_file: str
+) -> Optional[Dict[str, Tuple[np.ndarray, np.ndarray]]]:
+    """Load the z-score normalization scores stored next to the model weights
+    by save_mean_std_scores()
+
+    Parameters
+    ----------
+    weights_file : str
+        Path of the model weights, as given to model.load_weights().
+
+    Returns
+    -------
+    Optional[Dict[str, Tuple[np.ndarray, np.ndarray]]]
+        Dictionary containing the values needed for the z-score normalization,
+        or None if the weights have no sidecar file.
+    """
+    if not os.path.isfile(f"{weights_file}.mean_std.npz"):
+        return None
+
+    scores = dict()
+    with np.load(f"{weights_file}.mean_std.npz") as sidecar:
+        for key in sidecar.files:
+            param, value = key.rsplit("/", 1)
+            if value == "mean":
+                scores[param] = [sidecar[f"{param}/mean"], sidecar[f"{param}/scale"]]
+
+    return scores
+
+
 def train_and_evaluate(
     ds_path: Union[str, Tuple[str, str]],
     model: tf.keras.Model,
@@ -199,7 +276,13 @@ def train_and_evaluate(
         tensorboard_path = f"tensorboard/{model.name}"
 
     # Apply z-score normalization
-    model.set_mean_std_scores(get_mean_std_dict(ds_train, model.mean_std_scores_fields))
+    mean_std_scores = get_mean_std_dict(ds_train, model.mean_std_scores_fields)
+    model.set_mean_std_scores(mean_std_scores)
+    # the checkpoints overwrite the weights at each epoch, so the scores
+    # of a previous training must not be read with them in the meantime
+    weights_file = os.path.join(ckpt_path, "final_weight")
+    if os.path.isfile(f"{weights_file}.mean_std.npz"):
+        os.remove(f"{weights_file}.mean_std.npz")
 
     # Compile model
     model.compile(
@@ -211,7 +294,7 @@ def train_and_evaluate(
     
     #Create callbacks
     ckpt_callback = tf.keras.callbacks.ModelCheckpoint(
-        filepath=os.path.join(ckpt_path, "final_weight"),
+        filepath=weights_file,
         verbose=1,
         mode="min",
         save_best_only=False,
@@ -232,6 +315,8 @@ def train_and_evaluate(
         callbacks=[ckpt_callback, tensorboard_callback, nan_callback] + additional_callbacks,
         use_multiprocessing=True,
     )
+    # store the scores with the final weights
+    save_mean_std_scores(mean_std_scores, weights_file)
 
     return model, model.evaluate(ds_test)
 
@@ -245,6 +330,12 @@ if __name__ == "__main__":
     )
     parser.add_argument("--ckpt-path", type=str, required=True)
     parser.add_argument("--ds-train", type=str, required=True)
+    parser.add_argument("--iterations", type=int, required=False, default=8,
+                        help="Number of message-passing iterations of the model")
+    parser.add_argument("--path-state-dim", type=int, required=False, default=32,
+                        help="Size of the path states of the model")
+    parser.add_argument("--link-state-dim", type=int, required=False, default=32,
+                        help="Size of the link states of the model")
 
     args = parser.parse_args()
 
@@ -257,7 +348,8 @@ if __name__ == "__main__":
     _reset_seeds()
     trained_model, evaluation = train_and_evaluate(
         os.path.join(ds_path),
-        Model(),
+        Model(iterations=args.iterations, path_state_dim=args.path_state_dim,
+              link_state_dim=args.link_state_dim),
         **get_default_hyperparams(),
         ckpt_path=ckpt_path
     )
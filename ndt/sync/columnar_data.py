@@ -0,0 +1,173 @@
+"""
+Reader of the columnar dataset format written by
+data_management/generate_data.py (--format columnar)
+"""
+
+import os
+import json
+from typing import List, Dict, Any
+import numpy as np
+import tensorflow as tf
+
+SIGNATURE = (
+    {
+        "flow_traffic": tf.TensorSpec(shape=(None, 1), dtype=tf.float32),
+        "flow_loss_packet": tf.TensorSpec(shape=(None, 1), dtype=tf.float32),
+        "jitter": tf.TensorSpec(shape=(None, 1), dtype=tf.float32),
+        "flow_packet_size": tf.TensorSpec(shape=(None, 1), dtype=tf.float32),
+        "flow_propag_delay": tf.TensorSpec(shape=(None, 1), dtype=tf.float32),
+        "flow_delay_budget": tf.TensorSpec(shape=(None, 1), dtype=tf.float32),
+        "flow_length": tf.TensorSpec(shape=(None, 1), dtype=tf.float32),
+        "link_capacity": tf.TensorSpec(shape=(None, 1), dtype=tf.float32),
+        "link_to_flow": tf.TensorSpec(shape=(None, None), dtype=tf.int32),
+        "flow_to_link": tf.TensorSpec(shape=(None, None, 2), dtype=tf.int32),
+    },
+    tf.TensorSpec(shape=None, dtype=tf.float32),
+)
+
+
+def is_columnar(path: str) -> bool:
+    """Check if a dataset split is stored in columnar format
+    """
+    return os.path.isfile(f"{path}/metadata.json")
+
+
+def load_columns(path: str) -> Dict[str, Any]:
+    """Memory-map the columns of a split stored in columnar format
+
+    Parameters
+    ----------
+    path : str
+        Path to the dataset split.
+
+    Returns
+    -------
+    Dict[str, Any]
+        Dictionary with the split metadata, the memory-mapped flow columns (one
+        float32 value per flow), the per-sample index (flow offsets, graph and fold)
+        and the graph tensors of each graph id. Samples are ordered by fold.
+    """
+    with open(f"{path}/metadata.json", "r", encoding="utf-8") as f:
+        metadata = json.load(f)
+
+    columns = {}
+    for column in metadata["flow_features"] + ["label"]:
+        # np.memmap cannot map empty files
+        if metadata["n_flows"] == 0:
+            columns[column] = np.empty(0, dtype=np.float32)
+        else:
+            columns[column] = np.memmap(f"{path}/{column}.f32", dtype=np.float32,
+                                        mode="r", shape=(metadata["n_flows"],))
+
+    with np.load(f"{path}/index.npz") as index:
+        flow_offsets = index["flow_offsets"]
+        sample_graph = index["sample_graph"]
+        sample_fold = index["sample_fold"]
+
+    with np.load(f"{path}/graphs.npz") as graphs_file:
+        graphs = [{feature: graphs_file[f"{graph_id}/{feature}"]
+                   for feature in metadata["graph_features"]}
+                  for graph_id in range(metadata["n_graphs"])]
+
+    return {
+        "metadata": metadata,
+        "columns": columns,
+        "flow_offsets": flow_offsets,
+        "sample_graph": sample_graph,
+        # the training split is made of several folds, read in fold order
+        "order": np.argsort(sample_fold, kind="stable"),
+        "graphs": graphs,
+    }
+
+
+def load_columnar_dataset(path: str) -> tf.data.Dataset:
+    """Load a split stored in columnar format as a tf.data.Dataset, with
+    the same samples as the equivalent GZIP snapshot
+
+    Parameters
+    ----------
+    path : str
+        Path to the dataset split.
+
+    Returns
+    -------
+    tf.data.Dataset
+        Dataset whose samples are read from the memory-mapped columns, only
+        the flows of each sample being paged in and copied into its tensors.
+    """
+    split = load_columns(path)
+    columns = split["columns"]
+    flow_features = split["metadata"]["flow_features"]
+    # graph tensors rebuilt by the VTwin may not be stored
+    stored_features = flow_features + split["metadata"]["graph_features"]
+    signature = ({feature: spec for feature, spec in SIGNATURE[0].items()
+                  if feature in stored_features}, SIGNATURE[1])
+
+    def generator():
+        for sample_idx in split["order"]:
+            start = split["flow_offsets"][sample_idx]
+            end = split["flow_offsets"][sample_idx + 1]
+            features = {feature: columns[feature][start:end].reshape(-1, 1)
+                        for feature in flow_features}
+            features.update(split["graphs"][split["sample_graph"][sample_idx]])
+            yield features, columns["label"][start:end]
+
+    return tf.data.Dataset.from_generator(generator, output_signature=signature)
+
+
+def load_dataset(path: str) -> tf.data.Dataset:
+    """Load a dataset split, either stored in columnar format
+    or as a GZIP compressed tf.data snapshot
+    """
+    if is_columnar(path):
+        return load_columnar_dataset(path)
+    return tf.data.Dataset.load(path, compression="GZIP")
+
+
+def get_columnar_mean_std_dict(path: str, params: List[str]) -> Dict[str, List[np.ndarray]]:
+    """Get the mean-std normalization scores of a split stored in columnar format,
+    directly from its columns. Same result as std_train.get_mean_std_dict on
+    the loaded dataset, without iterating over its samples.
+
+    Parameters
+    ----------
+    path : str
+        Path to the dataset split.
+
+    params : List[str]
+        List of strings indicating the parameters to extract the features from.
+
+    Returns
+    -------
+    Dict[str, List[np.ndarray]]
+        Dictionary containing the mean of each parameter, and 1 / std
+        (or the std itself if it is zero).
+    """
+    split = load_columns(path)
+    graph_counts = np.bincount(split["sample_graph"], minlength=len(split["graphs"]))
+
+    scores = dict()
+    for param in params:
+        if param in split["columns"]:
+            values = split["columns"][param]
+            mean_val = np.mean(values, dtype=np.float64)
+            std_val = np.std(values, dtype=np.float64)
+        else:
+            # graph features are repeated in each sample of the graph
+            graph_values = [graph[param].reshape(graph[param].shape[0], -1).astype(np.float64)
+                            for graph in split["graphs"]]
+            n_values = sum(count * len(values)
+                           for count, values in zip(graph_counts, graph_values))
+            mean_val = sum(count * np.sum(values, axis=0)
+                           for count, values in zip(graph_counts, graph_values)) / n_values
+            std_val = np.sqrt(sum(count * np.sum((values - mean_val)**2, axis=0)
+                                  for count, values in zip(graph_counts, graph_values)) / n_values)
+        mean_val = np.atleast_1d(mean_val).astype(np.float32)
+        std_val = np.atleast_1d(std_val).astype(np.float32)
+
+        if all(std_val) == 0:
+            scores[param] = [mean_val, std_val]
+        else:
+            scores[param] = [mean_val, 1/std_val]
+
+    return scores
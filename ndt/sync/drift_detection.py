@@ -0,0 +1,336 @@
+"""
+Concept drift detectors updated with a whole window
+of flows at a time, and the monitor of a set of
+detectors configured from a file
+"""
+
+import abc
+import json
+import random
+import warnings
+import numpy as np
+from scipy import stats
+from river import drift
+
+
+class DriftDetector(abc.ABC):
+    """
+    Interface of the drift detectors. A detector is updated with the values
+    of a window of flows, as an array with one row per flow, and tells if a
+    drift was detected in them.
+    """
+    drift_detected = False
+
+    @abc.abstractmethod
+    def update(self, values):
+        """
+        Update the detector with the values of a window of flows
+
+        Parameters
+        ----------
+        values : np.ndarray
+            New values, in arrival order.
+
+        Returns
+        -------
+        bool
+            True if a drift is detected.
+        """
+
+
+class BatchKSWIN(DriftDetector):
+    """
+    Kolmogorov-Smirnov Windowing (KSWIN) drift detector, with the same parameters
+    and test as river.drift.KSWIN, updated with a window of values at a time.
+
+    The last window_size values are kept in a ring buffer. After each update, the
+    last stat_size values are compared with stat_size values drawn from the older
+    ones using a two-sample KS test, and a drift is detected if its p-value is at
+    most alpha and its statistic above 0.1. The test runs once per update, instead
+    of once per value. As in river, the detector restarts from an empty window after
+    a drift. The older values are drawn with random.Random(seed), as in river, so
+    updated with one value at a time, the detector reproduces the detections of
+    river.drift.KSWIN with the same seed; updated with larger windows, it tests
+    fewer times and its detections differ.
+
+    Parameters
+    ----------
+    alpha : float, optional
+        Probability for the test statistic of the KS test, by default 0.005
+
+    window_size : int, optional
+        Size of the sliding window, by default 100
+
+    stat_size : int, optional
+        Size of the statistic window, by default 30
+
+    seed : Optional[int], optional
+        Seed of the draws from the sliding window, by default None
+    """
+    def __init__(self, alpha=0.005, window_size=100, stat_size=30, seed=None):
+        if alpha < 0 or alpha > 1:
+            raise ValueError("Alpha must be between 0 and 1.")
+        if window_size < stat_size:
+            raise ValueError("stat_size must be smaller than window_size.")
+
+        self.alpha = alpha
+        self.window_size = window_size
+        self.stat_size = stat_size
+        self.seed = seed
+        self._reset()
+
+    def _reset(self):
+        self.window = np.empty(self.window_size, dtype=np.float64)
+        self.n_values = 0 # values in the sliding window
+        self.position = 0 # next position of the ring buffer
+        self.p_value = 0
+        self.drift_detected = False
+        self._rng = random.Random(self.seed)
+
+    def get_window(self):
+        """
+        Get the values of the sliding window, from the oldest to the newest
+        """
+        if self.n_values < self.window_size:
+            return self.window[:self.n_values]
+        return np.concatenate((self.window[self.position:], self.window[:self.position]))
+
+    def update(self, values):
+        """
+        Add a window of values to the sliding window, and test for a drift
+
+        Parameters
+        ----------
+        values : np.ndarray
+            New values, in arrival order.
+
+        Returns
+        -------
+        bool
+            True if a drift is detected.
+        """
+        if self.drift_detected:
+            self._reset()
+
+        values = np.asarray(values, dtype=np.float64).reshape(-1)[-self.window_size:]
+        # write the new values in the ring buffer, wrapping around its end
+        positions = (self.position + np.arange(len(values))) % self.window_size
+        self.window[positions] = values
+        self.position = (self.position + len(values)) % self.window_size
+        self.n_values = min(self.n_values + len(values), self.window_size)
+
+        if self.n_values < self.window_size:
+            # not enough values in the sliding window for a valid test
+            return self.drift_detected
+
+        window = self.get_window()
+        most_recent = window[self.window_size - self.stat_size:]
+        rnd_window = window[self._rng.sample(range(self.window_size - self.stat_size),
+                                             self.stat_size)]
+        # ks_2samp warns when its exact method falls back to the asymptotic one
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            statistic, self.p_value = stats.ks_2samp(rnd_window, most_recent, method="auto")
+        self.drift_detected = bool(self.p_value <= self.alpha and statistic > 0.1)
+
+        return self.drift_detected
+
+
+class RiverDetector(DriftDetector):
+    """
+    Univariate river drift detector (e.g. river.drift.ADWIN) updated with a
+    window of values, one at a time. A drift is detected if any of the values
+    triggers it, and the detector resets itself as in river.
+
+    Parameters
+    ----------
+    detector : river.base.DriftDetector
+        Detector to update.
+    """
+    def __init__(self, detector):
+        self.detector = detector
+
+    def update(self, values):
+        self.drift_detected = False
+        for value in np.asarray(values, dtype=np.float64).reshape(-1):
+            self.detector.update(value)
+            self.drift_detected = self.drift_detected or self.detector.drift_detected
+
+        return self.drift_detected
+
+
+class BatchHotelling(DriftDetector):
+    """
+    Multivariate drift detector, testing if the mean of the last stat_size rows
+    of a sliding window differs from the mean of the older rows with Hotelling's
+    two-sample T-squared test. A drift is detected if its p-value is at most
+    alpha, after which the detector restarts from an empty window.
+
+    Parameters
+    ----------
+    alpha : float, optional
+        Significance level of the test, by default 0.001
+
+    window_size : int, optional
+        Size of the sliding window, by default 100
+
+    stat_size : int, optional
+        Size of the statistic window, by default 30
+    """
+    def __init__(self, alpha=0.001, window_size=100, stat_size=30):
+        if alpha < 0 or alpha > 1:
+            raise ValueError("Alpha must be between 0 and 1.")
+        if window_size < stat_size:
+            raise ValueError("stat_size must be smaller than window_size.")
+
+        self.alpha = alpha
+        self.window_size = window_size
+        self.stat_size = stat_size
+        self._reset()
+
+    def _reset(self):
+        self.window = None # allocated on the first update, with one column per feature
+        self.n_values = 0
+        self.position = 0
+        self.p_value = 0
+        self.drift_detected = False
+
+    def update(self, values):
+        if self.drift_detected:
+            self._reset()
+
+        values = np.asarray(values, dtype=np.float64)
+        values = values.reshape(len(values), -1)[-self.window_size:]
+        if self.window is None:
+            self.window = np.empty((self.window_size, values.shape[1]), dtype=np.float64)
+        positions = (self.position + np.arange(len(values))) % self.window_size
+        self.window[positions] = values
+        self.position = (self.position + len(values)) % self.window_size
+        self.n_values = min(self.n_values + len(values), self.window_size)
+
+        if self.n_values < self.window_size:
+            return self.drift_detected
+
+        window = np.concatenate((self.window[self.position:], self.window[:self.position]))
+        reference = window[:self.window_size - self.stat_size]
+        most_recent = window[self.window_size - self.stat_size:]
+        n_ref, n_recent = len(reference), len(most_recent)
+
+        mean_diff = most_recent.mean(axis=0) - reference.mean(axis=0)
+        pooled_cov = ((n_ref - 1) * np.cov(reference, rowvar=False, ddof=1).reshape(values.shape[1], -1)
+                      + (n_recent - 1) * np.cov(most_recent, rowvar=False, ddof=1).reshape(values.shape[1], -1)
+                      ) / (n_ref + n_recent - 2)
+        # constant features (e.g. the packet size) do not add a dimension
+        n_dims = np.linalg.matrix_rank(pooled_cov)
+        if n_dims == 0:
+            self.p_value = 1.0
+            return self.drift_detected
+
+        t_squared = (n_ref * n_recent / (n_ref + n_recent)
+                     * mean_diff @ np.linalg.pinv(pooled_cov) @ mean_diff)
+        dof = n_ref + n_recent - n_dims - 1
+        f_value = dof / (n_dims * (n_ref + n_recent - 2)) * t_squared
+        self.p_value = stats.f.sf(f_value, n_dims, dof)
+        self.drift_detected = bool(self.p_value <= self.alpha)
+
+        return self.drift_detected
+
+
+def _make_detector(name, params):
+    """
+    Build a drift detector from its name and parameters
+    """
+    if name == "kswin":
+        return BatchKSWIN(**params)
+    if name == "adwin":
+        return RiverDetector(drift.ADWIN(**params))
+    if name == "page_hinkley":
+        return RiverDetector(drift.PageHinkley(**params))
+    if name == "hotelling":
+        return BatchHotelling(**params)
+    raise ValueError(f"Unknown drift detector: {name}")
+
+
+class DriftMonitor:
+    """
+    Set of drift detectors, each monitoring some per-flow features of the
+    stream, or the residual of the VTwin predictions ("residual").
+
+    Parameters
+    ----------
+    detectors : List[Dict[str, Any]]
+        Detectors configuration. Each one has the detector "name" (kswin, adwin,
+        page_hinkley or hotelling), the monitored "features", and the parameters
+        of the detector. Univariate detectors monitor a single feature.
+
+    rule : str, optional
+        Whether a drift is detected when "any" or "all" detectors detect
+        it in the same window, by default "any"
+    """
+    def __init__(self, detectors, rule="any"):
+        if rule not in ("any", "all"):
+            raise ValueError("The drift rule must be any or all!")
+
+        self.rule = rule
+        self.names = []
+        self.features = []
+        self.detectors = []
+        for config in detectors:
+            params = {key: value for key, value in config.items()
+                      if key not in ("name", "features")}
+            if config["name"] != "hotelling" and len(config["features"]) != 1:
+                raise ValueError(f"{config['name']} monitors a single feature!")
+            self.names.append(config["name"])
+            self.features.append(config["features"])
+            self.detectors.append(_make_detector(config["name"], params))
+        self.detected_by = []
+        self.drift_detected = False
+
+    def update(self, sample_features, residual=None):
+        """
+        Update the detectors with a window of flows
+
+        Parameters
+        ----------
+        sample_features : Dict[str, np.ndarray]
+            Per-flow features of the window.
+
+        residual : Optional[np.ndarray], optional
+            Per-flow residual of the VTwin predictions, by default None
+
+        Returns
+        -------
+        bool
+            True if a drift is detected.
+        """
+        self.detected_by = []
+        for name, features, detector in zip(self.names, self.features, self.detectors):
+            values = np.concatenate(
+                [np.asarray(residual if feature == "residual" else sample_features[feature],
+                            dtype=np.float64).reshape(-1, 1)
+                 for feature in features],
+                axis=1)
+            if detector.update(values):
+                self.detected_by.append(f"{name}({', '.join(features)})")
+
+        if self.rule == "all":
+            self.drift_detected = len(self.detected_by) == len(self.detectors)
+        else:
+            self.drift_detected = len(self.detected_by) > 0
+
+        return self.drift_detected
+
+
+def load_drift_monitor(config_file=None, window_size=100):
+    """
+    Load the drift monitor described by a JSON configuration file, see DriftMonitor.
+    Without a file, a single KSWIN monitors the flow traffic, as in the paper.
+    """
+    if config_file is None:
+        return DriftMonitor([{"name": "kswin", "features": ["flow_traffic"], "alpha": 0.001,
+                              "window_size": window_size, "stat_size": 1200, "seed": 42}])
+
+    with open(config_file, "r", encoding="utf-8") as f:
+        config = json.load(f)
+
+    return DriftMonitor(config["detectors"], config.get("rule", "any"))
@@ -0,0 +1,271 @@
+"""
+Local HTTP inference service of the VTwin, keeping the SavedModels
+exported by saved_model_export.py loaded, and predicting the
+concurrent requests to a model in micro-batches
+"""
+
+import os
+import json
+import time
+import queue
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import tensorflow as tf
+from std_base_model import BaseVirtualTwin
+
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
+
+
+class MicroBatcher:
+    """
+    Predict the requests to an exported VTwin in micro-batches. The requests
+    arriving within max_delay of the first one, up to max_batch of them, are
+    merged by graph shape into disjoint graphs, each predicted in one forward
+    pass, see BaseVirtualTwin.merge_samples()
+
+    Parameters
+    ----------
+    predict : Callable[[Dict[str, tf.Tensor]], tf.Tensor]
+        Forward pass of the exported VTwin.
+
+    features : List[str]
+        Input features of the exported VTwin.
+
+    max_batch : int, optional
+        Maximum number of requests per micro-batch, by default 16
+
+    max_delay : float, optional
+        Maximum time waited for the requests of a micro-batch, in
+        seconds, by default 0.002
+    """
+    def __init__(self, predict, features, max_batch=16, max_delay=0.002):
+        self.predict = predict
+        self.features = features
+        self.max_batch = max(max_batch, 1)
+        self.max_delay = max_delay
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, inputs):
+        """
+        Predict a sample, waiting for its micro-batch
+
+        Parameters
+        ----------
+        inputs : Dict[str, tf.Tensor]
+            Input features of the sample.
+
+        Returns
+        -------
+        np.ndarray
+            Per-flow predictions of the sample.
+        """
+        request = {"inputs": inputs, "done": threading.Event()}
+        self.requests.put(request)
+        request["done"].wait()
+        if "error" in request:
+            raise request["error"]
+
+        return request["predicted"]
+
+    def _next_batch(self):
+        batch = [self.requests.get()]
+        deadline = time.perf_counter() + self.max_delay
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self.requests.get(timeout=max(deadline - time.perf_counter(), 0)))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _run(self):
+        while True:
+            # same path length and flows per link, see BaseVirtualTwin.merge_samples()
+            batches = {}
+            for request in self._next_batch():
+                inputs = request["inputs"]
+                shape = (inputs["link_to_flow"].shape[1:], inputs["flow_to_link"].shape[1:])
+                batches.setdefault(shape, []).append(request)
+
+            for requests in batches.values():
+                try:
+                    merged, n_flows = BaseVirtualTwin.merge_samples(
+                        [request["inputs"] for request in requests])
+                    predicted = self.predict({feature: merged[feature] for feature in self.features})
+                    predictions = np.split(predicted.numpy(), np.cumsum(n_flows)[:-1])
+                    for request, request_predicted in zip(requests, predictions):
+                        request["predicted"] = request_predicted
+                except Exception as error:
+                    for request in requests:
+                        request["error"] = error
+                for request in requests:
+                    request["done"].set()
+
+
+class ExportedModel:
+    """
+    VTwin exported by saved_model_export.py, loaded once and kept in memory
+
+    Parameters
+    ----------
+    export_dir : str
+        Directory of the SavedModel.
+
+    max_batch : int, optional
+        Maximum number of requests per micro-batch, by default 16
+
+    max_delay : float, optional
+        Maximum time waited for the requests of a micro-batch, in
+        seconds, by default 0.002
+    """
+    def __init__(self, export_dir, max_batch=16, max_delay=0.002):
+        with open(os.path.join(export_dir, "assets", "vtwin.json"), "r", encoding="utf-8") as f:
+            self.metadata = json.load(f)
+        self.saved_model = tf.saved_model.load(export_dir)
+        # float features with a single value per flow or link, unlike the
+        # index tensors of the graph, e.g. link_to_flow
+        self.scalar_features = {
+            feature for feature, spec in self.metadata["inputs"].items()
+            if spec["dtype"].startswith("float") and spec.get("shape", [None, 1])[-1] == 1}
+        self.batcher = MicroBatcher(self.saved_model.predict, list(self.metadata["inputs"]),
+                                    max_batch, max_delay)
+
+    def parse_features(self, features):
+        """
+        Input features of a sample, from their JSON values. Scalar per-flow or
+        per-link features may be flat lists, while the graph tensors keep the
+        rank of the input signature, and samples without graph tensors get
+        those of an implicit graph, see BaseVirtualTwin.get_graph_tensors()
+        """
+        inputs = {}
+        for feature, spec in self.metadata["inputs"].items():
+            if feature not in features:
+                if feature in ("link_to_flow", "flow_to_link"):
+                    continue
+                raise ValueError(f"Missing input feature: {feature}")
+            value = np.asarray(features[feature], dtype=spec["dtype"])
+            if feature in self.scalar_features and value.ndim == spec["rank"] - 1:
+                value = value.reshape(-1, 1)
+            inputs[feature] = tf.constant(value)
+        if "link_to_flow" not in inputs or "flow_to_link" not in inputs:
+            inputs["link_to_flow"], inputs["flow_to_link"] = BaseVirtualTwin.get_graph_tensors(inputs)
+
+        return inputs
+
+    def predict(self, features):
+        """
+        Predict a sample given as JSON values, see parse_features()
+
+        Returns
+        -------
+        np.ndarray
+            Per-flow predictions, flattened, or with one
+            column per readout head for a multi-head model.
+        """
+        predicted = self.batcher.submit(self.parse_features(features))
+        if len(self.metadata["heads"]) == 1:
+            return predicted.reshape(-1)
+
+        return predicted
+
+
+def make_handler(models):
+    """
+    Request handler of the inference service:
+
+    - GET /models: description of the loaded models;
+    - POST /predict/<model>: per-flow predictions of the sample in the
+      request body, {"features": {<feature>: <values>}}, answered with
+      {"predictions": <values>}.
+    """
+    class InferenceHandler(BaseHTTPRequestHandler):
+        def _reply(self, status, body):
+            content = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def do_GET(self):
+            if self.path.rstrip("/") == "/models":
+                self._reply(200, {name: model.metadata for name, model in models.items()})
+            else:
+                self._reply(404, {"error": f"Unknown path: {self.path}"})
+
+        def do_POST(self):
+            name = self.path.rstrip("/").rsplit("/", 1)[-1]
+            if not self.path.startswith("/predict/") or name not in models:
+                self._reply(404, {"error": f"Unknown model: {self.path}"})
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                predicted = models[name].predict(request["features"])
+            except (KeyError, ValueError, tf.errors.InvalidArgumentError) as error:
+                self._reply(400, {"error": repr(error)})
+                return
+            except Exception as error:
+                self._reply(500, {"error": repr(error)})
+                return
+            self._reply(200, {"predictions": predicted.tolist()})
+
+        def log_message(self, format, *args):
+            # one line per request would slow down the service
+            pass
+
+    return InferenceHandler
+
+
+class InferenceServer(ThreadingHTTPServer):
+    """
+    HTTP server of the inference service, one thread per request
+    """
+    # the concurrent requests of a micro-batch overflow the default backlog of 5
+    request_queue_size = 128
+    daemon_threads = True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Serve the predictions of exported VTwin models over HTTP"
+    )
+    parser.add_argument(
+        "--model", "-m", help="Name and SavedModel directory of a model to serve, as "
+        "name=directory, e.g. delay=exports/delay. Can be repeated.",
+        type=str, action="append", required=True
+    )
+    parser.add_argument(
+        "--host", help="Address the service listens on.",
+        type=str, required=False, default="127.0.0.1"
+    )
+    parser.add_argument(
+        "--port", "-p", help="Port the service listens on.",
+        type=int, required=False, default=8080
+    )
+    parser.add_argument(
+        "--max-batch", help="Maximum number of requests to a model predicted together.",
+        type=int, required=False, default=16
+    )
+    parser.add_argument(
+        "--max-delay", help="Maximum time waited for the requests of a micro-batch, in ms.",
+        type=float, required=False, default=2.0
+    )
+
+    args = parser.parse_args()
+
+    served_models = {}
+    for model_arg in args.model:
+        model_name, model_dir = model_arg.split("=", 1)
+        served_models[model_name] = ExportedModel(model_dir, args.max_batch, args.max_delay / 1000)
+        print(f"=> Model {model_name} loaded from {model_dir}")
+
+    server = InferenceServer((args.host, args.port), make_handler(served_models))
+    print(f"=> Serving on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -0,0 +1,125 @@
+"""
+Latency and accuracy of the VTwin predictions for each number of
+message-passing iterations, and with the early exit of the message
+passing, to trade accuracy for speed on large topologies
+"""
+
+import os
+import time
+import argparse
+import numpy as np
+from columnar_data import load_dataset
+from std_train import stack_head_labels
+from ndt_loop import load_trained_model, get_nmse
+
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
+
+
+def profile_inference(model, windows, iterations=None, exit_tolerance=None):
+    """
+    Predict the windows one at a time, as in the NDT loop, with the given
+    message-passing iterations and early exit, see set_inference_mode()
+
+    Parameters
+    ----------
+    model : std_base_model.BaseVirtualTwin
+        Trained VTwin, with its mean-std scores set.
+
+    windows : List[Tuple[Dict[str, tf.Tensor], tf.Tensor]]
+        Features and labels of the windows, with a label column
+        per readout head, see std_train.stack_head_labels().
+
+    iterations : Optional[int], optional
+        Maximum number of iterations, by default the iterations of the model
+
+    exit_tolerance : Optional[float], optional
+        Tolerance of the early exit, by default None
+
+    Returns
+    -------
+    Tuple[float, float, float]
+        Median latency per window in ms, mean NMSE in dB, over
+        the readout heads too, and mean number of iterations run
+        per window.
+    """
+    model.set_inference_mode(windows[0][0], iterations=iterations, exit_tolerance=exit_tolerance)
+    model.warm_up([sample_features for sample_features, _ in windows])
+
+    latencies, nmses, iterations_run = [], [], []
+    for sample_features, labels in windows:
+        start_time = time.perf_counter()
+        predicted = model.predict_samples([sample_features], 1)[0]
+        latencies.append(time.perf_counter() - start_time)
+        nmses.append(get_nmse(labels.numpy(), predicted))
+        iterations_run.append(model.last_iterations)
+
+    return 1000 * np.median(latencies), np.mean(nmses), np.mean(iterations_run)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Profile the VTwin predictions for each number of message-passing iterations"
+    )
+    parser.add_argument(
+        "--weights", "-w", help="Weights file of the trained VTwin.",
+        type=str, required=True
+    )
+    parser.add_argument(
+        "--training-data", help="Training dataset of the VTwin, for its mean-std scores "
+        "when they are not stored next to the weights.",
+        type=str, required=True
+    )
+    parser.add_argument(
+        "--stream", "-s", help="Labeled windows to predict, e.g. a testing split.",
+        type=str, required=True
+    )
+    parser.add_argument(
+        "--target", "-g", help="QoS metric predicted by the VTwin.",
+        type=str, required=False, default="delay"
+    )
+    parser.add_argument(
+        "--windows", help="Maximum number of windows to predict.",
+        type=int, required=False, default=100
+    )
+    parser.add_argument(
+        "--iterations", help="Number of message-passing iterations the VTwin was trained with.",
+        type=int, required=False, default=8
+    )
+    parser.add_argument(
+        "--path-state-dim", help="Size of the path states of the VTwin.",
+        type=int, required=False, default=32
+    )
+    parser.add_argument(
+        "--link-state-dim", help="Size of the link states of the VTwin.",
+        type=int, required=False, default=32
+    )
+    parser.add_argument(
+        "--sparse", help="Sparse message passing from the flows to the links of their paths.",
+        action="store_true", required=False
+    )
+    parser.add_argument(
+        "--exit-tolerance", help="Tolerances of the early exit of the message passing to profile.",
+        type=float, nargs="*", required=False, default=[]
+    )
+
+    args = parser.parse_args()
+
+    trained_model = load_trained_model(args.training_data, args.weights, args.target, args.sparse,
+                                       {"iterations": args.iterations,
+                                        "path_state_dim": args.path_state_dim,
+                                        "link_state_dim": args.link_state_dim})
+    # a label column per readout head, as in the NDT loop
+    stream_windows = list(stack_head_labels(load_dataset(args.stream),
+                                     trained_model.heads).take(args.windows))
+
+    print(f"{'iterations':>12} {'tolerance':>10} {'latency (ms)':>13} {'NMSE (dB)':>10}")
+    previous_latency = 0.0
+    for n_iterations in range(1, args.iterations + 1):
+        latency, nmse, _ = profile_inference(trained_model, stream_windows, n_iterations)
+        print(f"{n_iterations:>12} {'-':>10} {latency:>13.2f} {nmse:>10.2f}"
+              f"   (+{latency - previous_latency:.2f} ms)")
+        previous_latency = latency
+    for exit_tolerance in args.exit_tolerance:
+        latency, nmse, mean_iterations = profile_inference(trained_model, stream_windows,
+                                                           exit_tolerance=exit_tolerance)
+        print(f"{mean_iterations:>12.2f} {exit_tolerance:>10g} {latency:>13.2f} {nmse:>10.2f}")
@@ -0,0 +1,85 @@
+"""
+Registry of the VTwin model in production, receiving
+new model versions by notification
+"""
+
+import queue
+
+
+class ModelRegistry:
+    """
+    Keep the VTwin model serving predictions, and swap new model versions
+    into it when they are notified, e.g. by the retraining process. Weights
+    and mean-std scores are assigned to the variables of the serving model,
+    so it is neither rebuilt nor retraced.
+
+    Parameters
+    ----------
+    model : tf.keras.Model
+        VTwin model in production, with its mean-std scores set.
+
+    version : int, optional
+        Version of the model in production, by default 0
+
+    notifications : optional
+        Queue where the new model versions are notified, by default a
+        new in-process queue. A multiprocessing queue can be given to
+        receive notifications from another process.
+    """
+    def __init__(self, model, version=0, notifications=None):
+        self.model = model
+        self.version = version
+        self.notifications = queue.SimpleQueue() if notifications is None else notifications
+
+    def notify(self, version, weights, mean_std_scores):
+        """
+        Notify a new model version
+
+        Parameters
+        ----------
+        version : int
+            Version of the new model.
+
+        weights : Union[str, List[np.ndarray]]
+            Path to the weights checkpoint of the new model,
+            or its weights as returned by model.get_weights().
+
+        mean_std_scores : Dict[str, List[np.ndarray]]
+            Mean-std normalization scores of the new model.
+        """
+        self.notifications.put((version, weights, mean_std_scores))
+
+    def poll(self):
+        """
+        Swap the newest notified model version into the serving model,
+        without blocking if there is none
+
+        Returns
+        -------
+        bool
+            True if a new model version is in production.
+        """
+        notification = None
+        while True:
+            try:
+                notification = self.notifications.get_nowait()
+            except queue.Empty:
+                break
+
+        if notification is None or notification[0] <= self.version:
+            return False
+
+        self.swap(*notification)
+        return True
+
+    def swap(self, version, weights, mean_std_scores):
+        """
+        Put a new model version in production, see notify()
+        """
+        if isinstance(weights, str):
+            # restores the checkpoint into the existing variables
+            self.model.load_weights(weights)
+        else:
+            self.model.set_weights(weights)
+        self.model.set_mean_std_scores(mean_std_scores)
+        self.version = version
@@ -10,7 +10,8 @@ import subprocess
 import numpy as np
 from river import drift
 from matplotlib import pyplot as plt
-from std_train import get_mean_std_dict, train_and_evaluate, get_default_hyperparams
+from std_train import (get_mean_std_dict, load_mean_std_scores,
+                       train_and_evaluate, get_default_hyperparams)
 import tensorflow as tf
 import std_delay_model
 
@@ -143,13 +144,15 @@ def _load_trained_model(training_data, model_weights_file):
         metrics=tf.keras.metrics.MeanAbsolutePercentageError()
     )
 
-    model.set_mean_std_scores(
-        get_mean_std_dict(
+    # the scores are stored next to the weights by train_and_evaluate
+    mean_std_scores = load_mean_std_scores(model_weights_file)
+    if mean_std_scores is None:
+        mean_std_scores = get_mean_std_dict(
             tf.data.Dataset.load(f"{training_data}/training",
             compression="GZIP"),
             model.mean_std_scores_fields,
         )
-    )
+    model.set_mean_std_scores(mean_std_scores)
 
     return model
 
@@ -0,0 +1,504 @@
+"""
+NDT loop shared by ndt_synchronization.py and ndt_sync_w_app.py:
+loading of the VTwin versions, pipelined prediction, drift detection
+and retraining over the stream of a topology, and their command-line
+arguments
+"""
+
+import os
+import pathlib
+import threading
+import numpy as np
+import tensorflow as tf
+from std_train import (get_split_mean_std_dict, load_mean_std_scores,
+                       train_and_evaluate, get_default_hyperparams, stack_head_labels)
+from columnar_data import load_dataset
+from drift_detection import load_drift_monitor
+from model_registry import ModelRegistry
+from pipeline import Pipeline, iter_chunks
+from replay_clock import ReplayClock
+from trainer_worker import TrainerWorker
+import std_delay_model
+import std_jitter_model
+import std_delay_jitter_model
+
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
+
+
+def run_ndt_loop(metrics_stage, realization: int, target: str, data_dir, topology, sync,
+                 database=None, finetune=False, freeze_embeddings=False, verbose=True,
+                 drift_config=None, speed=1.0, flow_interval=1.0, retrain_time=0.0,
+                 pipeline_depth=4, inference_batch=1, jit_compile=False, sparse=False,
+                 iterations=8, path_state_dim=32, link_state_dim=32, exit_tolerance=None):
+    """
+    Replay the stream of a topology through the VTwin: predict its windows,
+    detect drifts and, with sync, retrain the VTwin and put the new versions
+    in production. The prediction, the drift detection and the metrics of
+    the windows run as the stages of a pipeline, see pipeline.Pipeline.
+
+    Parameters
+    ----------
+    metrics_stage : Callable[[List[Tuple]], None]
+        Last stage of the pipeline, recording the metrics of a micro-batch of
+        windows, each one as (window index, replay time, last flow ID,
+        features, labels, predictions). With a multi-head VTwin, e.g. the
+        delay_jitter target, labels and predictions have a column per head.
+
+    database : Optional[str], optional
+        Name of the labeled and traffic databases of the topology, by
+        default the database of the first readout head of the VTwin,
+        e.g. delay_database
+
+    Other parameters are the options of the command line, see add_ndt_arguments()
+
+    Returns
+    -------
+    Tuple[List[int], List[int], List[float], List[int]]
+        Windows where a drift was detected and where a new model version went
+        in production, replay time of each window, and message-passing
+        iterations run for each window.
+    """
+    untrained_model = load_untrained_model(target)
+    # the other heads read their labels from the samples of the first one
+    database = database or f"{untrained_model.heads[0]}_database"
+    root_data_dir = data_dir # root directory for the database
+    if topology == "5g_crosshaul":
+        dataset_name = "experiment_10"
+        window_size = 6800
+    elif topology == "germany":
+        window_size = 7000
+        dataset_name = "experiment_20"
+    elif topology == "passion":
+        dataset_name = "experiment_30"
+        window_size = 6800
+    elif topology == "random":
+        dataset_name = "experiment_40"
+        window_size = 10000
+    else:
+        raise ValueError("This is not a supported topology!")
+
+    # Create the output directory
+    output_path_name = f"results/{topology}/"
+    if os.path.isfile(output_path_name):
+        os.remove(output_path_name)
+    else:
+        pathlib.Path(output_path_name).mkdir(parents=True, exist_ok=True)
+
+    # Create the weights directory
+    weights_path_name = f"weights/{topology}/"
+    if os.path.isfile(weights_path_name):
+        os.remove(weights_path_name)
+    else:
+        pathlib.Path(weights_path_name).mkdir(parents=True, exist_ok=True)
+
+    model_version = 0
+    async_running = False
+    # hyperparameters of the VTwin, the same for all model versions
+    model_params = {"iterations": iterations, "path_state_dim": path_state_dim,
+                    "link_state_dim": link_state_dim}
+    training_data_path = f"{root_data_dir}/labeled_database/{database}/{topology}/{dataset_name}"
+    training_data = [f"{training_data_path}0_cv",
+                    f"{training_data_path}1_cv",
+                    f"{training_data_path}2_cv",
+                    f"{training_data_path}4_cv"]
+
+    model_weights_dir = f"../../data_management/weights_database/{topology}/model_version"
+
+    if not os.path.isfile(f"{model_weights_dir}_{model_version}/{target}_final_weight.index"):
+        print("Training the initial model!!")
+        initial_training_vtwin(training_data[model_version],
+                                    untrained_model,
+                                    model_weights_dir,
+                                    topology=topology,
+                                    realization=realization,
+                                    target=target,
+                                    model_params=model_params)
+
+    stream_data_path = f"{root_data_dir}/traffic_database/{database}/{topology}/{dataset_name}"
+    stream_data_dir = [f"{stream_data_path}0_cv/testing",
+                        f"{stream_data_path}1_cv/testing",
+                        f"{stream_data_path}2_cv/testing",
+                        f"{stream_data_path}4_cv/testing"]
+
+    stream_data = load_dataset(f"{stream_data_dir[0]}")
+
+    for stream_dir in stream_data_dir[1:]:
+        new_data = load_dataset(stream_dir)
+        stream_data = stream_data.concatenate(new_data)
+    stream_data = stack_head_labels(stream_data, untrained_model.heads)
+
+    trained_model = load_trained_model(training_data[model_version],
+                                        f"{model_weights_dir}_{model_version}/{target}_final_weight",
+                                        target, sparse, model_params)
+    # trace the inference function, and compile it with XLA if asked, for
+    # each graph shape of the topology, so the stream does not stall on it
+    training_samples = load_dataset(f"{training_data[model_version]}/training").map(lambda x, y: x)
+    trained_model.set_inference_mode(next(iter(training_samples)), jit_compile,
+                                     exit_tolerance=exit_tolerance)
+    n_shapes = trained_model.warm_up(training_samples, inference_batch)
+    print(f"Inference function ready for {n_shapes} graph shapes")
+    # new model versions are notified when their retraining is over
+    model_registry = ModelRegistry(trained_model, model_version)
+    indexes, points = [], []
+    flow_id = 0
+
+    # defining the concept drift detectors, a KSWIN on the flow traffic by default
+    drift_monitor = load_drift_monitor(drift_config, window_size)
+    # retraining worker, with the training step traced while the stream starts
+    model_training = TrainerWorker(target, training_data[model_version],
+                                   finetune, freeze_embeddings, model_params) if sync else None
+    # replay of the stream, and timestamped retraining results
+    clock = ReplayClock(speed, flow_interval)
+    retraining_end = None
+    window_times = []
+    # message-passing iterations run for each window
+    window_iterations = []
+    model_updated = []
+    drift_detected = []
+    # retrainings requested by the drift detection, with their window,
+    # version and end time, and windows where retrainings ended
+    retraining_requests = []
+    retraining_over = []
+    requested_version = model_version
+    # windows processed by the drift detection, and end time of the predicted windows
+    drift_progress = threading.Condition()
+    drift_windows = 0
+    window_ends = []
+
+    def inference_stage(windows):
+        """
+        Replay a micro-batch of windows, put new model versions
+        in production and predict the windows together
+        """
+        nonlocal flow_id, retraining_end, model_version, async_running
+        window_index = windows[0][0]
+        last_flow_ids = flow_id - 1 + np.cumsum([len(labels) for _, (_, labels) in windows])
+        batch_end = clock.flow_time(last_flow_ids[-1])
+
+        # the drift detection is at most pipeline_depth windows behind, and
+        # catches up with the windows whose drift would end a retraining
+        # before this one, so the retrainings start at their drift window
+        # and the new models are in production at the same window in every run
+        with drift_progress:
+            while (drift_windows < window_index - pipeline_depth
+                   or sync and not async_running and drift_windows < window_index
+                   and window_ends[drift_windows] + retrain_time <= batch_end) \
+                    and not pipeline.stopped.is_set():
+                drift_progress.wait(timeout=0.1)
+            if retraining_requests:
+                _, model_version, retraining_end = retraining_requests.pop(0)
+                async_running = True
+        window_ends.extend(clock.flow_time(last_flow_id) for last_flow_id in last_flow_ids)
+
+        # the windows are complete when the last flow arrives, and
+        # nothing can happen before if no retraining is running
+        clock.advance_to(batch_end, idle=not async_running)
+        if async_running:
+            if clock.paced:
+                training_result = model_training.poll()
+                if training_result is not None:
+                    clock.schedule(clock.time, "retrained", training_result)
+            elif clock.time >= retraining_end:
+                # at max speed, the replay waits for the retraining, so the
+                # new model is in production at the same window in every run
+                clock.schedule(retraining_end, "retrained", model_training.wait())
+        for event_time, kind, payload in clock.due_events():
+            if kind == "retrained":
+                print(f"\nRetraining is over at {event_time:.1f} s")
+                _, weights_file, _ = payload
+                if weights_file is not None:
+                    model_registry.notify(model_version, weights_file,
+                                          get_trained_mean_std_dict(
+                                              training_data[model_version],
+                                              weights_file,
+                                              model_registry.model.mean_std_scores_fields))
+                retraining_over.append(window_index)
+                async_running = False
+
+        # update virtual twin model
+        if model_registry.poll():
+            print("\nNew model")
+            model_updated.append(window_index)
+            print(f"Model version {model_registry.version} in production")
+
+        # one forward pass for the windows with the same graph shape
+        predictions = model_registry.model.predict_samples(
+            [sample_features for _, (sample_features, _) in windows], inference_batch)
+        window_iterations.extend(model_registry.model.sample_iterations)
+        flow_id = last_flow_ids[-1] + 1
+
+        return [(window_index, clock.time, last_flow_id, sample_features, labels.numpy(), predicted)
+                for (window_index, (sample_features, labels)), last_flow_id, predicted
+                in zip(windows, last_flow_ids, predictions)]
+
+    def drift_stage(windows):
+        """
+        Detect drifts, and request the retraining of the VTwin
+        """
+        nonlocal requested_version, drift_windows
+        for window_index, window_time, last_flow_id, sample_features, labels, predicted in windows:
+            # drift detection runs once per window of flows, on
+            # the residual of the first head for a multi-head VTwin
+            residual = (labels - predicted).reshape(len(labels), -1)[:, 0]
+            drift_monitor.update(sample_features, residual=residual)
+            # the inference is ahead, so all the retrainings over by this window are known
+            retraining = requested_version > sum(over <= window_index for over in retraining_over)
+            if sync and drift_monitor.drift_detected and not retraining:
+                drift_detected.append(window_index)
+                if requested_version + 2 <= len(training_data):
+                    print(f"\n\033[31m=> Drift detected by {', '.join(drift_monitor.detected_by)}\033[0m")
+                    indexes.append(last_flow_id)
+                    points.append(sample_features["flow_traffic"].numpy())
+                    print("\033[32m=> Retraining the VTwin\033[0m")
+                    requested_version += 1
+                    model_training.submit(requested_version,
+                                          training_data[requested_version],
+                                          f"{model_weights_dir}_{requested_version}",
+                                          topology=topology,
+                                          realization=realization,
+                                          # warm start from the model in production
+                                          init_weights=f"{model_weights_dir}_{model_registry.version}/{target}_final_weight")
+                    with drift_progress:
+                        retraining_requests.append((window_index, requested_version,
+                                                    window_time + retrain_time))
+
+            with drift_progress:
+                drift_windows += 1
+                drift_progress.notify_all()
+
+        return windows
+
+    def record_stage(windows):
+        """
+        Record the metrics and the replay time of the windows
+        """
+        metrics_stage(windows)
+        for _, window_time, last_flow_id, _, _, _ in windows:
+            window_times.append(window_time)
+            if verbose:
+                print("\r Analyzing flow ID: ", last_flow_id, end="", flush=True)
+
+    pipeline = Pipeline([inference_stage, drift_stage, record_stage], pipeline_depth)
+    pipeline.run(iter_chunks(enumerate(stream_data.prefetch(tf.data.AUTOTUNE)), inference_batch))
+    if model_training is not None:
+        model_training.close()
+    print("\n=> Assessement finished!")
+    if exit_tolerance is not None:
+        print(f"=> {np.mean(window_iterations):.2f} message-passing iterations per window "
+              f"on average, out of {iterations}")
+
+    return drift_detected, model_updated, window_times, window_iterations
+
+
+def load_untrained_model(target):
+    """
+    function to load model without training weights
+    """
+    if target == "delay":
+        model = std_delay_model.VirtualTwin
+    elif target == "jitter":
+        model = std_jitter_model.VirtualTwin
+    elif target == "delay_jitter":
+        model = std_delay_jitter_model.VirtualTwin
+    else:
+        raise ValueError("Choose a proper QoS predictor model!")
+
+    return model
+
+
+def load_trained_model(training_data, model_weights_file, target, sparse=False,
+                       model_params=None):
+    """
+    function to load a trained GNN model, with the hyperparameters
+    it was trained with in model_params
+    """
+    model_params = model_params or {}
+
+    if target == "delay":
+        model = std_delay_model.VirtualTwin(sparse=sparse, **model_params)
+    elif target == "jitter":
+        model = std_jitter_model.VirtualTwin(sparse=sparse, **model_params)
+    elif target == "delay_jitter":
+        model = std_delay_jitter_model.VirtualTwin(sparse=sparse, **model_params)
+    else:
+        raise ValueError("Choose a proper QoS predictor model!")
+    model.load_weights(model_weights_file)
+
+    # Compile the model
+    model.compile(
+        optimizer=tf.keras.optimizers.Adam(learning_rate=0.001),
+        loss=tf.keras.losses.MeanAbsolutePercentageError(),
+        metrics=tf.keras.metrics.MeanAbsolutePercentageError()
+    )
+
+    model.set_mean_std_scores(
+        get_trained_mean_std_dict(
+            training_data,
+            model_weights_file,
+            model.mean_std_scores_fields,
+        )
+    )
+
+    return model
+
+
+def get_trained_mean_std_dict(training_data, model_weights_file, params):
+    """
+    function to get the mean-std scores of a trained GNN model
+    """
+    # the scores are stored next to the weights by train_and_evaluate
+    mean_std_scores = load_mean_std_scores(model_weights_file)
+    if mean_std_scores is None:
+        mean_std_scores = get_split_mean_std_dict(
+            f"{training_data}/training",
+            params,
+        )
+
+    return mean_std_scores
+
+
+def get_nmse(ground_truth, predicted):
+    """
+    function to compute the NMSE of the
+    per-flow predictions, in dB, one per
+    column for several readout heads
+    """
+    err_metric = np.mean((ground_truth - predicted)**2, axis=0)/np.mean(ground_truth**2, axis=0)
+
+    return 10*np.log10(err_metric)
+
+
+def initial_training_vtwin(training_data, model,
+                                model_weights_dir,
+                                topology,
+                                realization,
+                                target,
+                                model_params=None,
+                                model_version=0):
+    """
+    function to training GNN model
+    """
+    model_weights_dir = f"{model_weights_dir}_{model_version}/"
+    train_and_evaluate(
+        os.path.join(training_data),
+        model(**(model_params or {})),
+        **get_default_hyperparams(model.heads),
+        ckpt_path=model_weights_dir,
+        topology=topology,
+        realization=realization,
+        target=target
+    )
+
+
+def add_ndt_arguments(parser):
+    """
+    Add the command-line arguments of the NDT loop to a parser,
+    see get_loop_options()
+    """
+    parser.add_argument(
+        "--topology", "-t", help="Type of topology to be used in the experiments.",
+        type=str, required=True
+    )
+    parser.add_argument(
+        "--dir", "-d", help="Path to network traffic datasets.",
+        type=str, required=True
+    )
+    parser.add_argument(
+        "--realization", "-r", help="Number of realization to be performed.",
+        type=int, required=True
+    )
+    parser.add_argument(
+        "--sync", "-s", help="Enable twin synchronization.",
+        action="store_true", required=False
+    )
+    parser.add_argument(
+        "--finetune", "-f", help="Fine-tune the model in production when retraining.",
+        action="store_true", required=False
+    )
+    parser.add_argument(
+        "--freeze-embeddings", help="Freeze the embedding layers when fine-tuning.",
+        action="store_true", required=False
+    )
+    parser.add_argument(
+        "--quiet", "-q", help="Do not print the analyzed flow ID of each window.",
+        action="store_true", required=False
+    )
+    parser.add_argument(
+        "--speed", help="Replay speed of the stream, 1 for real time, N for N times "
+        "faster, or 0 for as fast as possible.",
+        type=float, required=False, default=1.0
+    )
+    parser.add_argument(
+        "--flow-interval", help="Time between two flow arrivals in the replay, in seconds.",
+        type=float, required=False, default=1.0
+    )
+    parser.add_argument(
+        "--retrain-time", help="Replay time of a retraining when replaying as fast as "
+        "possible, in seconds.",
+        type=float, required=False, default=0.0
+    )
+    parser.add_argument(
+        "--pipeline-depth", help="Number of windows the drift detection can lag behind "
+        "the prediction.",
+        type=int, required=False, default=4
+    )
+    parser.add_argument(
+        "--inference-batch", help="Number of windows predicted together, in one forward "
+        "pass when they have the same graph shape.",
+        type=int, required=False, default=1
+    )
+    parser.add_argument(
+        "--jit-compile", help="Compile the inference function of the VTwin with XLA.",
+        action="store_true", required=False
+    )
+    parser.add_argument(
+        "--sparse", help="Sparse message passing from the flows to the links of their paths.",
+        action="store_true", required=False
+    )
+    parser.add_argument(
+        "--iterations", help="Number of message-passing iterations of the VTwin.",
+        type=int, required=False, default=8
+    )
+    parser.add_argument(
+        "--path-state-dim", help="Size of the path states of the VTwin.",
+        type=int, required=False, default=32
+    )
+    parser.add_argument(
+        "--link-state-dim", help="Size of the link states of the VTwin.",
+        type=int, required=False, default=32
+    )
+    parser.add_argument(
+        "--exit-tolerance", help="Stop the message passing of the predictions once no "
+        "path state changes by more than this tolerance in an iteration.",
+        type=float, required=False, default=None
+    )
+    parser.add_argument(
+        "--drift-config", "-c", help="JSON configuration of the drift detectors.",
+        type=str, required=False, default=None
+    )
+
+
+def get_loop_options(args):
+    """
+    Options of run_ndt_loop() from the arguments parsed by add_ndt_arguments()
+    """
+    return {
+        "data_dir": args.dir,
+        "topology": args.topology,
+        "sync": args.sync,
+        "finetune": args.finetune,
+        "freeze_embeddings": args.freeze_embeddings,
+        "verbose": not args.quiet,
+        "drift_config": args.drift_config,
+        "speed": args.speed,
+        "flow_interval": args.flow_interval,
+        "retrain_time": args.retrain_time,
+        "pipeline_depth": args.pipeline_depth,
+        "inference_batch": args.inference_batch,
+        "jit_compile": args.jit_compile,
+        "sparse": args.sparse,
+        "iterations": args.iterations,
+        "path_state_dim": args.path_state_dim,
+        "link_state_dim": args.link_state_dim,
+        "exit_tolerance": args.exit_tolerance,
+    }
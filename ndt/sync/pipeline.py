@@ -0,0 +1,124 @@
+"""
+Pipelined executor running the stages of the NDT loop
+concurrently, connected by bounded queues
+"""
+
+import queue
+import threading
+
+_END = object() # marks the end of the stream in the queues
+
+
+class Pipeline:
+    """
+    Chain of stages, each one running in its own thread. A stage is a
+    function taking the output of the previous stage, or an item of the
+    source for the first stage, and returning its own output. The items
+    go through every stage in order, and each queue between two stages
+    holds at most depth items, so a slow stage slows down the previous
+    ones instead of letting them fall behind without bound.
+
+    TensorFlow and NumPy release the GIL in their kernels, so
+    the prediction of a window overlaps with the drift detection
+    and the metrics of the previous windows.
+
+    Parameters
+    ----------
+    stages : List[Callable[[Any], Any]]
+        Stages of the pipeline, in order.
+
+    depth : int, optional
+        Capacity of the queues between two stages, by default 4
+    """
+    def __init__(self, stages, depth=4):
+        self.stages = stages
+        self.depth = max(depth, 1)
+        self.stopped = threading.Event()
+        self.error = None
+
+    def _put(self, items, item):
+        while not self.stopped.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, items):
+        while not self.stopped.is_set():
+            try:
+                return items.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _END
+
+    def _fail(self, error):
+        if self.error is None:
+            self.error = error
+        self.stopped.set()
+
+    def _feed(self, source, outputs):
+        try:
+            for item in source:
+                if not self._put(outputs, item):
+                    return
+            self._put(outputs, _END)
+        except Exception as error:
+            self._fail(error)
+
+    def _run_stage(self, stage, inputs, outputs):
+        try:
+            for item in iter(lambda: self._get(inputs), _END):
+                result = stage(item)
+                if outputs is not None and not self._put(outputs, result):
+                    return
+            if outputs is not None:
+                self._put(outputs, _END)
+            else:
+                # the last stage processed the whole stream
+                self.stopped.set()
+        except Exception as error:
+            self._fail(error)
+
+    def run(self, source):
+        """
+        Feed the items of source through the stages, and wait until they
+        are all processed. If a stage raises an exception, the pipeline
+        stops and the exception is raised again here.
+
+        Parameters
+        ----------
+        source : Iterable[Any]
+            Items of the stream, e.g. a tf.data.Dataset.
+        """
+        queues = [queue.Queue(maxsize=self.depth) for _ in self.stages]
+        threads = [threading.Thread(target=self._feed, args=(source, queues[0]), daemon=True)]
+        for i, stage in enumerate(self.stages):
+            outputs = queues[i + 1] if i + 1 < len(self.stages) else None
+            threads.append(threading.Thread(target=self._run_stage,
+                                            args=(stage, queues[i], outputs),
+                                            daemon=True))
+        for thread in threads:
+            thread.start()
+
+        self.stopped.wait()
+        if self.error is not None:
+            raise self.error
+        for thread in threads:
+            thread.join()
+
+
+def iter_chunks(items, size):
+    """
+    Group the items in lists of size items, in order, the last list
+    holding the remaining items
+    """
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
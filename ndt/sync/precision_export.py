@@ -0,0 +1,169 @@
+"""
+Export of a trained VTwin with lower-precision weights, checking
+its accuracy on a testing split against the float32 model
+"""
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import tensorflow as tf
+from columnar_data import load_dataset
+from std_train import save_mean_std_scores, stack_head_labels
+from ndt_loop import load_trained_model, get_nmse
+
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
+
+
+def cast_model(model, precision, sample):
+    """
+    Copy of a trained VTwin, with its weights and computations in the given
+    precision, see std_base_model.BaseVirtualTwin
+
+    Parameters
+    ----------
+    model : std_base_model.BaseVirtualTwin
+        Trained VTwin, with its mean-std scores set.
+
+    precision : str
+        Precision of the copy, bfloat16 or float16.
+
+    sample : Dict[str, tf.Tensor]
+        Input features of a sample, to build the layers of the copy.
+
+    Returns
+    -------
+    std_base_model.BaseVirtualTwin
+        VTwin in the given precision.
+    """
+    cast = type(model)(model.mean_std_scores, sparse=model.sparse, heads=model.heads,
+                       iterations=model.iterations, path_state_dim=model.path_state_dim,
+                       link_state_dim=model.link_state_dim, precision=precision)
+    # the layers of both models are built on their first call
+    model.infer(sample)
+    cast.infer(sample)
+    cast.set_weights([tf.cast(weights, precision).numpy() for weights in model.get_weights()])
+
+    return cast
+
+
+def evaluate(model, windows):
+    """
+    Predict the windows one at a time, as in the NDT loop
+
+    Returns
+    -------
+    Tuple[float, float, List[np.ndarray]]
+        Mean NMSE in dB, over the readout heads too, median
+        latency per window in ms, and prediction of each window.
+    """
+    model.set_inference_mode(windows[0][0])
+    model.warm_up([sample_features for sample_features, _ in windows])
+
+    nmses, latencies, predictions = [], [], []
+    for sample_features, labels in windows:
+        start_time = time.perf_counter()
+        predicted = model.predict_samples([sample_features], 1)[0]
+        latencies.append(time.perf_counter() - start_time)
+        nmses.append(get_nmse(labels.numpy(), predicted))
+        predictions.append(predicted)
+
+    return np.mean(nmses), 1000 * np.median(latencies), predictions
+
+
+def weights_size(model):
+    """
+    Size of the weights of a model, in bytes
+    """
+    return sum(weights.nbytes for weights in model.get_weights())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Export a trained VTwin with lower-precision weights"
+    )
+    parser.add_argument(
+        "--weights", "-w", help="Weights file of the trained VTwin.",
+        type=str, required=True
+    )
+    parser.add_argument(
+        "--training-data", help="Training dataset of the VTwin, for its mean-std scores "
+        "when they are not stored next to the weights.",
+        type=str, required=True
+    )
+    parser.add_argument(
+        "--testing", help="Testing split on which the accuracy of the export is checked.",
+        type=str, required=True
+    )
+    parser.add_argument(
+        "--target", "-g", help="QoS metric predicted by the VTwin.",
+        type=str, required=False, default="delay"
+    )
+    parser.add_argument(
+        "--precision", "-p", help="Precision of the exported weights, bfloat16 or float16.",
+        type=str, required=False, default="bfloat16", choices=["bfloat16", "float16"]
+    )
+    parser.add_argument(
+        "--output", "-o", help="Weights file of the export, by default the weights "
+        "file suffixed with the precision.",
+        type=str, required=False, default=None
+    )
+    parser.add_argument(
+        "--max-nmse-increase", help="Largest increase of the mean NMSE over the float32 "
+        "model, in dB, for the export to be saved.",
+        type=float, required=False, default=0.5
+    )
+    parser.add_argument(
+        "--windows", help="Maximum number of windows of the testing split to predict.",
+        type=int, required=False, default=1000
+    )
+    parser.add_argument(
+        "--iterations", help="Number of message-passing iterations of the VTwin.",
+        type=int, required=False, default=8
+    )
+    parser.add_argument(
+        "--path-state-dim", help="Size of the path states of the VTwin.",
+        type=int, required=False, default=32
+    )
+    parser.add_argument(
+        "--link-state-dim", help="Size of the link states of the VTwin.",
+        type=int, required=False, default=32
+    )
+    parser.add_argument(
+        "--sparse", help="Sparse message passing from the flows to the links of their paths.",
+        action="store_true", required=False
+    )
+
+    args = parser.parse_args()
+
+    trained_model = load_trained_model(args.training_data, args.weights, args.target, args.sparse,
+                                       {"iterations": args.iterations,
+                                        "path_state_dim": args.path_state_dim,
+                                        "link_state_dim": args.link_state_dim})
+    # a label column per readout head, as in the NDT loop
+    testing_windows = list(stack_head_labels(load_dataset(args.testing),
+                                     trained_model.heads).take(args.windows))
+    cast_trained_model = cast_model(trained_model, args.precision, testing_windows[0][0])
+
+    nmse, latency, predictions = evaluate(trained_model, testing_windows)
+    cast_nmse, cast_latency, cast_predictions = evaluate(cast_trained_model, testing_windows)
+    # error of the export with respect to the float32 model itself
+    relative_error = np.mean([np.abs(cast_predicted - predicted).max() / np.abs(predicted).max()
+                              for predicted, cast_predicted in zip(predictions, cast_predictions)])
+
+    print(f"{'':>10} {'NMSE (dB)':>10} {'latency (ms)':>13} {'weights (kB)':>13}")
+    print(f"{'float32':>10} {nmse:>10.2f} {latency:>13.2f} {weights_size(trained_model) / 1024:>13.1f}")
+    print(f"{args.precision:>10} {cast_nmse:>10.2f} {cast_latency:>13.2f} "
+          f"{weights_size(cast_trained_model) / 1024:>13.1f}")
+    print(f"Mean relative error of the {args.precision} predictions: {relative_error:.2e}")
+
+    if cast_nmse - nmse > args.max_nmse_increase:
+        print(f"The NMSE increases by {cast_nmse - nmse:.2f} dB, more than "
+              f"{args.max_nmse_increase} dB, the export is not saved!")
+        sys.exit(1)
+
+    output = f"{args.weights}_{args.precision}" if args.output is None else args.output
+    cast_trained_model.save_weights(output)
+    save_mean_std_scores(cast_trained_model.mean_std_scores, output)
+    print(f"Exported to {output}")
@@ -0,0 +1,96 @@
+"""
+Virtual clock replaying the traffic stream in real
+time, faster than real time, or as fast as possible
+"""
+
+import heapq
+import time
+
+
+class ReplayClock:
+    """
+    Clock of the stream replay. Flow i arrives at the virtual time
+    i * flow_interval, and the stream is replayed at speed times the
+    real time, or as fast as possible if speed is 0.
+
+    Events, such as the end of a retraining, are scheduled at a virtual
+    time and delivered once the clock reaches it. While no event can
+    happen in the meantime (idle clock), the clock jumps forward without
+    waiting, since nothing would differ if it waited.
+
+    Parameters
+    ----------
+    speed : float, optional
+        Replay speed, 1 for real time, N for N times faster than real time,
+        or 0 for as fast as possible. By default 1.
+
+    flow_interval : float, optional
+        Virtual time between two flow arrivals, in seconds. By default 1.
+    """
+    def __init__(self, speed=1.0, flow_interval=1.0):
+        if speed < 0:
+            raise ValueError("The replay speed must be positive, or 0 for max speed!")
+
+        self.speed = speed
+        self.flow_interval = flow_interval
+        self.time = 0.0
+        self._origin = None # wall time of the virtual time 0
+        self._events = []
+        self._n_events = 0 # keeps the order of events scheduled at the same time
+
+    @property
+    def paced(self):
+        """
+        Whether the replay follows the wall clock
+        """
+        return self.speed > 0
+
+    def flow_time(self, flow_id):
+        """
+        Virtual arrival time of a flow
+        """
+        return flow_id * self.flow_interval
+
+    def advance_to(self, virtual_time, idle=False):
+        """
+        Move the clock to a virtual time, waiting for the corresponding wall time
+        when the replay is paced, unless the clock is idle
+
+        Parameters
+        ----------
+        virtual_time : float
+            Virtual time to move to.
+
+        idle : bool, optional
+            If True, no event can happen before virtual_time, and the clock
+            jumps to it without waiting. By default False
+        """
+        if self.paced:
+            if self._origin is None or idle:
+                self._origin = time.perf_counter() - virtual_time / self.speed
+            else:
+                time.sleep(max(0.0, self._origin + virtual_time / self.speed - time.perf_counter()))
+        self.time = max(self.time, virtual_time)
+
+    def schedule(self, virtual_time, kind, payload=None):
+        """
+        Schedule an event, delivered by due_events() once the clock reaches its time
+        """
+        heapq.heappush(self._events, (virtual_time, self._n_events, kind, payload))
+        self._n_events += 1
+
+    def due_events(self):
+        """
+        Get the events scheduled up to the current virtual time
+
+        Returns
+        -------
+        List[Tuple[float, str, Any]]
+            Time, kind and payload of each event, in time order.
+        """
+        events = []
+        while self._events and self._events[0][0] <= self.time:
+            event_time, _, kind, payload = heapq.heappop(self._events)
+            events.append((event_time, kind, payload))
+
+        return events
@@ -0,0 +1,146 @@
+"""
+Export of a trained VTwin as a self-contained SavedModel, with
+its weights and mean-std normalization scores, e.g. served by
+inference_server.py
+"""
+
+import os
+import json
+import argparse
+import numpy as np
+import tensorflow as tf
+from columnar_data import load_dataset
+from ndt_loop import load_trained_model
+
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
+
+# description of the export, next to the SavedModel assets
+METADATA_FILE = os.path.join("assets", "vtwin.json")
+
+
+def export_saved_model(model, sample, export_dir, target):
+    """
+    Save the forward pass of a trained VTwin as a SavedModel. The mean-std
+    scores are variables of the export, so the clients send the raw features.
+    The export has a "predict" function, taking a dict of features, and a
+    "serving_default" signature, taking them as named inputs and returning
+    the "predictions", both for graphs of any size.
+
+    Parameters
+    ----------
+    model : std_base_model.BaseVirtualTwin
+        Trained VTwin, with its mean-std scores set.
+
+    sample : Dict[str, tf.Tensor]
+        Input features of a sample, for the input signature.
+
+    export_dir : str
+        Directory of the SavedModel.
+
+    target : str
+        QoS metric predicted by the VTwin.
+
+    Returns
+    -------
+    Dict[str, Any]
+        Description of the export, saved in METADATA_FILE.
+    """
+    # the features read by the forward pass, with the graph tensors
+    features = sorted(model.mean_std_scores_fields) + ["link_to_flow", "flow_to_link"]
+    input_signature = model.get_input_signature(sample, features)
+
+    @tf.function(input_signature=[input_signature])
+    def predict(inputs):
+        return model.forward(inputs)
+
+    @tf.function(input_signature=[input_signature])
+    def serving_default(inputs):
+        return {"predictions": predict(inputs)}
+
+    export = tf.Module()
+    export.model = model
+    # the mean-std scores are not tracked by the model, see _MeanStdVariables
+    export.mean_std_scores = [variable for variables in model.mean_std_variables.scores.values()
+                              for variable in variables]
+    export.predict = predict
+    tf.saved_model.save(export, export_dir,
+                        signatures={"serving_default": serving_default.get_concrete_function()})
+
+    metadata = {
+        "target": target,
+        "heads": list(model.heads),
+        "iterations": model.iterations,
+        "precision": model.precision,
+        "inputs": {feature: {"dtype": spec.dtype.name, "rank": len(spec.shape),
+                             "shape": spec.shape.as_list()}
+                   for feature, spec in input_signature.items()},
+    }
+    os.makedirs(os.path.join(export_dir, "assets"), exist_ok=True)
+    with open(os.path.join(export_dir, METADATA_FILE), "w", encoding="utf-8") as f:
+        json.dump(metadata, f, indent=2)
+
+    return metadata
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Export a trained VTwin as a SavedModel"
+    )
+    parser.add_argument(
+        "--weights", "-w", help="Weights file of the trained VTwin.",
+        type=str, required=True
+    )
+    parser.add_argument(
+        "--training-data", help="Training dataset of the VTwin, for its mean-std scores "
+        "when they are not stored next to the weights, and the input signature.",
+        type=str, required=True
+    )
+    parser.add_argument(
+        "--output", "-o", help="Directory of the SavedModel.",
+        type=str, required=True
+    )
+    parser.add_argument(
+        "--target", "-g", help="QoS metric predicted by the VTwin.",
+        type=str, required=False, default="delay"
+    )
+    parser.add_argument(
+        "--iterations", help="Number of message-passing iterations of the VTwin.",
+        type=int, required=False, default=8
+    )
+    parser.add_argument(
+        "--path-state-dim", help="Size of the path states of the VTwin.",
+        type=int, required=False, default=32
+    )
+    parser.add_argument(
+        "--link-state-dim", help="Size of the link states of the VTwin.",
+        type=int, required=False, default=32
+    )
+    parser.add_argument(
+        "--precision", help="Precision of the weights, as exported by precision_export.py.",
+        type=str, required=False, default="float32", choices=["float32", "bfloat16", "float16"]
+    )
+    parser.add_argument(
+        "--sparse", help="Sparse message passing from the flows to the links of their paths.",
+        action="store_true", required=False
+    )
+
+    args = parser.parse_args()
+
+    trained_model = load_trained_model(args.training_data, args.weights, args.target, args.sparse,
+                                       {"iterations": args.iterations,
+                                        "path_state_dim": args.path_state_dim,
+                                        "link_state_dim": args.link_state_dim,
+                                        "precision": args.precision})
+    samples = [sample_features for sample_features, _ in
+               load_dataset(f"{args.training_data}/training").take(10)]
+    export_metadata = export_saved_model(trained_model, samples[0], args.output, args.target)
+
+    # the export predicts as the model it comes from
+    exported = tf.saved_model.load(args.output)
+    max_error = 0.0
+    for sample in samples:
+        link_to_flow, flow_to_link = trained_model.get_graph_tensors(sample)
+        inputs = dict(sample, link_to_flow=link_to_flow, flow_to_link=flow_to_link)
+        predicted = exported.predict({feature: inputs[feature] for feature in export_metadata["inputs"]})
+        max_error = max(max_error, np.abs(predicted.numpy() - trained_model.infer(sample).numpy()).max())
+    print(f"Exported to {args.output}, largest difference with the model: {max_error:.2e}")
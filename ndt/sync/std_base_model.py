@@ -0,0 +1,644 @@
+"""
+Message-passing backbone of the VTwin models, shared by
+the per-flow QoS predictors through their readout heads
+Created by: Cláudio Modesto
+"""
+
+import numpy as np
+import tensorflow as tf
+import keras.backend as K
+
+
+class _MeanStdVariables:
+    """
+    Mean-std scores held in variables, so a traced model reads the
+    current scores and new ones are set without retracing it. Being
+    a plain object, its variables are not tracked as model weights
+    """
+    def __init__(self):
+        self.scores = {}
+
+    def assign(self, mean_std_scores):
+        for param, values in mean_std_scores.items():
+            values = [tf.cast(value, tf.float32) for value in values]
+            if param not in self.scores:
+                self.scores[param] = [tf.Variable(value, trainable=False) for value in values]
+            else:
+                for variable, value in zip(self.scores[param], values):
+                    variable.assign(value)
+
+
+def _float32_orthogonal(shape, dtype=None):
+    """
+    Orthogonal initializer computed in float32, and cast to dtype
+    """
+    return tf.cast(tf.keras.initializers.Orthogonal()(shape, dtype=tf.float32), dtype)
+
+
+def delay_head(occupancy, capacity_gather, inputs):
+    """
+    Per-flow delay: the queuing delay of the flow on each link of
+    its path, occupancy over capacity, plus its propagation delay
+    """
+    delay = occupancy / capacity_gather
+    delay = tf.math.reduce_sum(delay, axis=1)
+
+    return delay + inputs["flow_propag_delay"]
+
+
+def jitter_head(ratio_gather, capacity_gather, inputs):
+    """
+    Per-flow jitter: the sum of the jitter ratios
+    over capacity on the links of the flow path
+    """
+    ratio_gather_normalized = ratio_gather / capacity_gather
+
+    return tf.math.reduce_sum(ratio_gather_normalized, axis=1)
+
+
+# readout heads by name, each one mapping the output of its readout layer on
+# the path states, one value per hop, to a per-flow QoS metric
+READOUT_HEADS = {
+    "delay": delay_head,
+    "jitter": jitter_head,
+}
+
+
+class BaseVirtualTwin(tf.keras.Model):
+    """
+    VTwin description considering 4 flow features and 2 link features as
+    input data. The message passing is shared, and each readout head predicts
+    a QoS metric from the final path states, see READOUT_HEADS. With several
+    heads, the output has one column per head, in order, from a single
+    forward pass.
+
+    Parameters
+    ----------
+    override_mean_std_scores : Optional[Dict[str, List[float]]], optional
+        Mean-std scores of the input features, by default None
+
+    name : Optional[str], optional
+        Name of the model, by default None
+
+    sparse : bool, optional
+        If True, the messages from the flows to the links are sparse, see
+        forward(). By default False
+
+    heads : Optional[Sequence[str]], optional
+        Readout heads of the model, by default the heads of the class
+
+    iterations : int, optional
+        Number of message-passing iterations, by default 8
+
+    path_state_dim : int, optional
+        Size of the path (flow) states, by default 32
+
+    link_state_dim : int, optional
+        Size of the link states, by default 32
+
+    precision : str, optional
+        Precision of the weights and computations of the layers, float32,
+        bfloat16 or float16. The inputs, their normalization and the readout
+        heads stay in float32. By default float32
+    """
+    heads = ("delay",)
+
+    mean_std_scores_fields = {
+        "flow_traffic",
+        "link_capacity",
+        "flow_propag_delay",
+        "flow_length",
+        "flow_loss_packet"
+    }
+
+    mean_std_scores = None
+
+    inference_function = None
+
+    # iterations of the inference function, and tolerance on the change
+    # of the path states to stop the message passing, see set_inference_mode()
+    inference_iterations = None
+
+    exit_tolerance = None
+
+    # iterations run by the last forward pass of infer(), and by the
+    # forward pass of each sample of the last predict_samples() call
+    last_iterations = None
+
+    sample_iterations = None
+
+    name = "virtual_twin"
+
+    def __init__(self, override_mean_std_scores=None, name=None, sparse=False, heads=None,
+                 iterations=8, path_state_dim=32, link_state_dim=32, precision="float32"):
+        super(BaseVirtualTwin, self).__init__()
+
+        if iterations < 1:
+            raise ValueError("The message passing needs at least one iteration!")
+        self.iterations = iterations
+        # sparse message passing from the flows to the links, see forward()
+        self.sparse = sparse
+        self.mean_std_variables = _MeanStdVariables()
+        self.path_state_dim = path_state_dim
+        self.link_state_dim = link_state_dim
+
+        if override_mean_std_scores is not None:
+            self.set_mean_std_scores(override_mean_std_scores)
+        if name is not None:
+            assert isinstance(name, str), "name must be a string"
+            self.name = name
+
+        if heads is not None:
+            self.heads = tuple(heads)
+        for head in self.heads:
+            if head not in READOUT_HEADS:
+                raise ValueError(f"Unknown readout head: {head}")
+        # the readout layer of the first head keeps the name it has in the
+        # single-head models, whose existing checkpoints keep loading
+        self.readout_names = tuple("readout_path" if i == 0 else f"readout_path_{head}"
+                                   for i, head in enumerate(self.heads))
+        self.precision = precision
+        # the layers take the dtype policy in force when they are created
+        default_policy = tf.keras.mixed_precision.global_policy()
+        tf.keras.mixed_precision.set_global_policy(precision)
+        try:
+            self._build_layers()
+        finally:
+            tf.keras.mixed_precision.set_global_policy(default_policy)
+
+    def _build_layers(self):
+        self.attention = tf.keras.Sequential(
+            [tf.keras.layers.Input(shape=(None, None, self.path_state_dim)),
+            tf.keras.layers.Dense(
+                self.path_state_dim, activation=tf.keras.layers.LeakyReLU(alpha=0.2)
+            ),
+            ]
+        )
+
+        # the QR decomposition of the orthogonal initializer has no bfloat16 kernel
+        recurrent_initializer = _float32_orthogonal if self.precision == "bfloat16" else "orthogonal"
+
+        # GRU Cells used in the Message Passing step
+        self.path_update = tf.keras.layers.RNN(
+            tf.keras.layers.GRUCell(self.path_state_dim, name="PathUpdate",
+                                    recurrent_initializer=recurrent_initializer,
+            ),
+            return_sequences=True,
+            return_state=True,
+            name="PathUpdateRNN",
+        )
+        self.link_update = tf.keras.layers.GRUCell(
+            self.link_state_dim, name="LinkUpdate",
+            recurrent_initializer=recurrent_initializer,
+        )
+
+        self.flow_embedding = tf.keras.Sequential(
+            [
+                tf.keras.layers.Input(shape=4),
+                tf.keras.layers.Dense(
+                    self.path_state_dim, activation=tf.keras.activations.selu,
+                    kernel_initializer='lecun_uniform',
+                    ),
+                tf.keras.layers.Dense(
+                    self.path_state_dim, activation=tf.keras.activations.selu,
+                    kernel_initializer='lecun_uniform',
+                    )
+            ],
+            name="PathEmbedding",
+        )
+
+        self.link_embedding = tf.keras.Sequential(
+            [
+                tf.keras.layers.Input(shape=2),
+                tf.keras.layers.Dense(
+                    self.link_state_dim, activation=tf.keras.activations.selu,
+                    kernel_initializer='lecun_uniform',
+                    ),
+                tf.keras.layers.Dense(
+                    self.link_state_dim, activation=tf.keras.activations.selu,
+                    kernel_initializer='lecun_uniform',
+                    )
+            ],
+            name="LinkEmbedding",
+        )
+
+        for head, readout_name in zip(self.heads, self.readout_names):
+            layer_name = "PathReadout" if readout_name == "readout_path" else f"PathReadout_{head}"
+            setattr(self, readout_name, self._build_readout(layer_name))
+
+    def _build_readout(self, layer_name):
+        return tf.keras.Sequential(
+            [
+                tf.keras.layers.Input(shape=(None, self.path_state_dim)),
+                tf.keras.layers.Dense(
+                    self.link_state_dim // 2, activation=tf.keras.activations.selu,
+                    kernel_initializer='lecun_uniform',
+                    ),
+                tf.keras.layers.Dense(
+                    self.link_state_dim // 4, activation=tf.keras.activations.selu,
+                    kernel_initializer='lecun_uniform',
+                    ),
+                tf.keras.layers.Dense(1, activation=tf.keras.activations.softplus)
+            ],
+            name=layer_name,
+        )
+
+    def set_mean_std_scores(self, override_mean_std_scores):
+        assert (
+            isinstance(override_mean_std_scores, dict)
+            and all(kk in override_mean_std_scores for kk in self.mean_std_scores_fields)
+            and all(len(val) == 2 for val in override_mean_std_scores.values())
+        ), "overriden mean-std dict is not valid!"
+        self.mean_std_scores = override_mean_std_scores
+        self.mean_std_variables.assign(override_mean_std_scores)
+
+    def check_readout_weights(self, weights_file):
+        """
+        Check that a checkpoint has the weights of every readout head of the
+        model. The readout layers missing from a checkpoint would otherwise
+        keep their initial weights, e.g. the jitter head of a multi-head
+        model loading the checkpoint of a single-head delay model
+
+        Raises
+        ------
+        ValueError
+            If a readout head has no weights in the checkpoint.
+        """
+        saved_layers = {name.split("/")[0] for name, _ in tf.train.list_variables(weights_file)}
+        missing_heads = [head for head, readout_name in zip(self.heads, self.readout_names)
+                         if readout_name not in saved_layers]
+        if missing_heads:
+            raise ValueError(f"{weights_file} has no weights for the readout heads "
+                             f"{', '.join(missing_heads)} of the model!")
+
+    def load_weights(self, filepath, *args, **kwargs):
+        """
+        Load the weights of a checkpoint, see tf.keras.Model.load_weights(),
+        after checking it has every readout head, see check_readout_weights()
+        """
+        self.check_readout_weights(filepath)
+        return super(BaseVirtualTwin, self).load_weights(filepath, *args, **kwargs)
+
+    @staticmethod
+    def get_graph_tensors(inputs):
+        """
+        Get the link_to_flow and flow_to_link tensors of a sample. Samples
+        generated with --implicit-graph do not store them, so they are
+        built here by broadcasting, from the number of flows and links
+        """
+        if "link_to_flow" in inputs and "flow_to_link" in inputs:
+            return inputs["link_to_flow"], inputs["flow_to_link"]
+
+        n_flows = tf.shape(inputs["flow_traffic"])[0]
+        n_links = tf.shape(inputs["link_capacity"])[0]
+        # links are indexed by their position on the connection path
+        link_to_flow = tf.broadcast_to(tf.range(n_links), [n_flows, n_links])
+        # every link is crossed by all flows of the sample
+        flow_ids = tf.stack([tf.range(n_flows), tf.zeros([n_flows], dtype=tf.int32)], axis=1)
+        flow_to_link = tf.broadcast_to(flow_ids, [n_links, n_flows, 2])
+
+        return link_to_flow, flow_to_link
+
+    @classmethod
+    def merge_samples(cls, samples):
+        """
+        Merge samples into a single disjoint graph, offsetting the flow and
+        link indices of each sample by the flows and links of the previous
+        ones. The graph tensors of the samples must have the same shape, but
+        for their first dimension (same path length and flows per link)
+
+        Returns
+        -------
+        Tuple[Dict[str, tf.Tensor], List[int]]
+            Inputs of the merged graph, and number of flows of each sample.
+        """
+        n_flows = [int(inputs["flow_traffic"].shape[0]) for inputs in samples]
+        n_links = [int(inputs["link_capacity"].shape[0]) for inputs in samples]
+        flow_offsets = np.cumsum([0] + n_flows[:-1])
+        link_offsets = np.cumsum([0] + n_links[:-1])
+
+        link_to_flow, flow_to_link = [], []
+        for inputs, flow_offset, link_offset in zip(samples, flow_offsets, link_offsets):
+            sample_link_to_flow, sample_flow_to_link = cls.get_graph_tensors(inputs)
+            link_to_flow.append(sample_link_to_flow + int(link_offset))
+            # only the flow ids are offset, not the positions on the path
+            flow_to_link.append(sample_flow_to_link + [int(flow_offset), 0])
+
+        merged = {feature: tf.concat([inputs[feature] for inputs in samples], axis=0)
+                  for feature in samples[0] if feature not in ("link_to_flow", "flow_to_link")}
+        merged["link_to_flow"] = tf.concat(link_to_flow, axis=0)
+        merged["flow_to_link"] = tf.concat(flow_to_link, axis=0)
+
+        return merged, n_flows
+
+    def predict_samples(self, samples, batch_size=16):
+        """
+        Predict several samples, merging up to batch_size consecutive samples
+        with the same graph shape in one forward pass, see merge_samples()
+
+        Parameters
+        ----------
+        samples : Iterable[Dict[str, tf.Tensor]]
+            Input features of the samples.
+
+        batch_size : int, optional
+            Maximum number of samples per forward pass, by default 16
+
+        Returns
+        -------
+        List[np.ndarray]
+            Prediction of each sample, flattened, or with one
+            column per readout head for a multi-head model.
+        """
+        predictions, iterations = [], []
+        batch, batch_shape = [], None
+        for inputs in samples:
+            link_to_flow, flow_to_link = self.get_graph_tensors(inputs)
+            shape = (link_to_flow.shape[1:], flow_to_link.shape[1:])
+            if batch and (shape != batch_shape or len(batch) == batch_size):
+                predictions.extend(self._predict_merged(batch))
+                iterations.extend([self.last_iterations] * len(batch))
+                batch = []
+            batch.append(inputs)
+            batch_shape = shape
+        if batch:
+            predictions.extend(self._predict_merged(batch))
+            iterations.extend([self.last_iterations] * len(batch))
+        self.sample_iterations = np.array(iterations)
+
+        return predictions
+
+    def _predict_merged(self, samples):
+        output_shape = (-1,) if len(self.heads) == 1 else (-1, len(self.heads))
+        if len(samples) == 1:
+            return [self.infer(samples[0]).numpy().reshape(output_shape)]
+        inputs, n_flows = self.merge_samples(samples)
+        predicted = self.infer(inputs).numpy().reshape(output_shape)
+        return np.split(predicted, np.cumsum(n_flows)[:-1])
+
+    def _with_graph_tensors(self, inputs):
+        if "link_to_flow" in inputs and "flow_to_link" in inputs:
+            return inputs
+        link_to_flow, flow_to_link = self.get_graph_tensors(inputs)
+        return dict(inputs, link_to_flow=link_to_flow, flow_to_link=flow_to_link)
+
+    def get_input_signature(self, sample, features=None):
+        """
+        Input signature of the features of a sample, with the dimensions
+        changing from a graph to another of any size
+
+        Parameters
+        ----------
+        sample : Dict[str, tf.Tensor]
+            Input features of a sample.
+
+        features : Optional[Iterable[str]], optional
+            Features of the signature, by default all the features of the
+            sample, and its graph tensors
+
+        Returns
+        -------
+        Dict[str, tf.TensorSpec]
+            Specification of each feature, named after it.
+        """
+        inputs = self._with_graph_tensors(sample)
+        features = inputs.keys() if features is None else features
+        # the number of flows and links, the path length and the flows per link
+        # change with the graph, not the feature size or the (flow, position) pairs
+        return {feature: tf.TensorSpec(shape=[None] * (len(inputs[feature].shape) - 1)
+                                       + [None if feature == "link_to_flow" else inputs[feature].shape[-1]],
+                                       dtype=inputs[feature].dtype, name=feature)
+                for feature in features}
+
+    def set_inference_mode(self, sample, jit_compile=False, iterations=None, exit_tolerance=None):
+        """
+        Predict with an inference function whose input signature has the
+        features of the given sample, with dimensions of any size. It is
+        traced once for all graph shapes, instead of retracing call() when
+        a new shape shows up. With jit_compile, the function is compiled
+        with XLA, once per input shape, see warm_up()
+
+        Parameters
+        ----------
+        sample : Dict[str, tf.Tensor]
+            Input features of a sample.
+
+        jit_compile : bool, optional
+            If True, the inference function is compiled with XLA, by default False
+
+        iterations : Optional[int], optional
+            Maximum number of message-passing iterations, by default
+            the iterations of the model
+
+        exit_tolerance : Optional[float], optional
+            If given, the message passing stops early, once no path state changes
+            by more than exit_tolerance in an iteration, see forward(). The
+            iterations run are in last_iterations and sample_iterations.
+            By default None
+        """
+        input_signature = [self.get_input_signature(sample)]
+        self.inference_iterations = self.iterations if iterations is None else iterations
+        self.exit_tolerance = exit_tolerance
+
+        def inference_function(inputs):
+            return self.forward(inputs, self.inference_iterations, exit_tolerance)
+
+        self.inference_function = tf.function(inference_function, input_signature=input_signature,
+                                              jit_compile=jit_compile)
+
+    def warm_up(self, samples, batch_size=1):
+        """
+        Predict one sample of each graph shape found in samples, e.g. the samples
+        of a topology, merged with up to batch_size copies of itself as in
+        predict_samples(), so the inference function is traced and compiled
+        before the stream starts
+
+        Returns
+        -------
+        int
+            Number of graph shapes found.
+        """
+        shapes = {}
+        for inputs in samples:
+            link_to_flow, flow_to_link = self.get_graph_tensors(inputs)
+            shape = (tuple(inputs["flow_traffic"].shape), tuple(link_to_flow.shape),
+                     tuple(flow_to_link.shape))
+            shapes.setdefault(shape, inputs)
+        for inputs in shapes.values():
+            for n_samples in range(1, batch_size + 1):
+                self.predict_samples([inputs] * n_samples, batch_size)
+
+        return len(shapes)
+
+    def infer(self, inputs):
+        """
+        Predict a sample, with the inference function if
+        the inference mode is set, or else with call()
+        """
+        if self.inference_function is None:
+            self.last_iterations = self.iterations
+            return self(inputs)
+        predicted = self.inference_function(self._with_graph_tensors(inputs))
+        if self.exit_tolerance is None:
+            self.last_iterations = self.inference_iterations
+            return predicted
+        predicted, iterations = predicted
+        self.last_iterations = int(iterations)
+        return predicted
+
+    @tf.function
+    def call(self, inputs):
+        return self.forward(inputs)
+
+    def forward(self, inputs, iterations=None, exit_tolerance=None):
+        """
+        Forward pass of the VTwin, traced by call() and the inference function.
+        With exit_tolerance, the message passing stops once the largest change
+        of a path state in an iteration is at most exit_tolerance, and the
+        number of iterations run is returned with the predictions
+        """
+        if iterations is None:
+            iterations = self.iterations
+
+        # Ensure that the std-mean scores are set
+        assert self.mean_std_scores is not None, "the model cannot be called before setting the mean-std scores!"
+
+        mean_std = self.mean_std_variables.scores
+
+        # Process raw inputs
+        flow_traffic = inputs["flow_traffic"]
+        flow_length = inputs["flow_length"]
+        flow_loss_packet = inputs["flow_loss_packet"]
+        flow_propag_delay = inputs["flow_propag_delay"]
+        link_capacity = inputs["link_capacity"]
+        link_to_flow, flow_to_link = self.get_graph_tensors(inputs)
+
+        if self.sparse:
+            # one edge per hop of the flow paths, from the flow to the link,
+            # instead of the dense (flow, 0) pairs of flow_to_link per link
+            n_links = tf.shape(link_capacity)[0]
+            edge_link = tf.reshape(link_to_flow, [-1])
+            edge_flow = tf.repeat(tf.range(tf.shape(link_to_flow)[0]), tf.shape(link_to_flow)[1])
+            load = tf.math.unsorted_segment_mean(
+                tf.gather(flow_traffic, edge_flow), edge_link, n_links
+            ) / link_capacity
+        else:
+            path_gather_traffic = tf.gather(flow_traffic, flow_to_link[:, :, 0])
+            load = tf.math.reduce_mean(path_gather_traffic, axis=1) / link_capacity
+
+        # Initialize the initial hidden state for paths
+        path_state = self.flow_embedding(
+            tf.concat(
+                [
+                    (flow_traffic - mean_std["flow_traffic"][0])
+                    * mean_std["flow_traffic"][1],
+                    (flow_length - mean_std["flow_length"][0])
+                    * mean_std["flow_length"][1],
+                    (flow_loss_packet - mean_std["flow_loss_packet"][0])
+                    * mean_std["flow_loss_packet"][1],
+                    (flow_propag_delay - mean_std["flow_propag_delay"][0])
+                    * mean_std["flow_propag_delay"][1],
+                ],
+                axis=1,
+            )
+        )
+
+        # Initialize the initial hidden state for links
+        link_state = self.link_embedding(
+            tf.concat(
+                [
+                    (link_capacity - mean_std["link_capacity"][0])
+                    * mean_std["link_capacity"][1],
+                    load
+                ],
+                axis=1,
+            ),
+        )
+
+        def message_passing(path_state, link_state):
+            """
+            One iteration of the message passing
+            """
+            ####################
+            #  LINKS TO PATH   #
+            ####################
+            link_gather = tf.gather(link_state, link_to_flow, name="LinkToPath")
+            previous_path_state = path_state
+
+            path_state_sequence, path_state = self.path_update(
+                link_gather, initial_state=path_state
+            )
+
+            # We select the element in path_state_sequence
+            # so that it corresponds to the state before the link was considered
+            path_state_sequence = tf.concat(
+                [tf.expand_dims(previous_path_state, 1), path_state_sequence], axis=1
+            )
+
+            ###################
+            #   PATH TO LINK  #
+            ###################
+            if self.sparse:
+                # the state of each flow before the iteration, as
+                # with the (flow, 0) pairs of flow_to_link
+                path_gather = tf.gather(previous_path_state, edge_flow, name="FlowToLink")
+                attention_score = self.attention(tf.expand_dims(path_gather, 0))[0]
+                normalized_score = K.softmax(attention_score)
+                weighted_score = normalized_score * path_gather
+                path_gather_score = tf.math.unsorted_segment_sum(weighted_score, edge_link, n_links)
+            else:
+                path_gather = tf.gather_nd(
+                    path_state_sequence, flow_to_link, name="FlowToLink"
+                )
+
+                attention_score = self.attention(path_gather)
+                normalized_score = K.softmax(attention_score)
+                weighted_score = normalized_score * path_gather
+                path_gather_score = tf.reduce_sum(weighted_score, axis=1)
+            link_state, _ = self.link_update(path_gather_score, states=link_state)
+
+            return path_state_sequence, path_state, link_state, previous_path_state
+
+        # Iterate t times doing the message passing
+        path_state_sequence, path_state, link_state, previous_path_state = message_passing(
+            path_state, link_state
+        )
+        if exit_tolerance is None:
+            for _ in range(iterations - 1):
+                path_state_sequence, path_state, link_state, _ = message_passing(
+                    path_state, link_state
+                )
+        else:
+            def not_converged(iteration, path_state_sequence, path_state, link_state, change):
+                return tf.logical_and(iteration < iterations, change > exit_tolerance)
+
+            def next_iteration(iteration, path_state_sequence, path_state, link_state, change):
+                path_state_sequence, path_state, link_state, previous_path_state = message_passing(
+                    path_state, link_state
+                )
+                change = tf.reduce_max(tf.abs(path_state - previous_path_state))
+                return iteration + 1, path_state_sequence, path_state, link_state, change
+
+            iteration, path_state_sequence, path_state, link_state, _ = tf.while_loop(
+                not_converged, next_iteration,
+                (tf.constant(1), path_state_sequence, path_state, link_state,
+                 tf.reduce_max(tf.abs(path_state - previous_path_state)))
+            )
+
+        ################
+        #  READOUT     #
+        ################
+
+        capacity_gather = tf.gather(link_capacity, link_to_flow)
+
+        predictions = [
+            READOUT_HEADS[head](tf.cast(getattr(self, readout_name)(path_state_sequence[:, 1:]),
+                                        capacity_gather.dtype),
+                                capacity_gather, inputs)
+            for head, readout_name in zip(self.heads, self.readout_names)
+        ]
+        predictions = predictions[0] if len(predictions) == 1 else tf.concat(predictions, axis=1)
+        if exit_tolerance is None:
+            return predictions
+
+        return predictions, iteration
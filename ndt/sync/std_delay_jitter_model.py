@@ -0,0 +1,16 @@
+"""
+GNN model declaration used as VTwin to predict per-flow delay
+and jitter from a single forward pass
+"""
+
+from std_base_model import BaseVirtualTwin
+
+
+class VirtualTwin(BaseVirtualTwin):
+    """
+    VTwin description considering 4 flow features
+    and 2 link features as input data, with the
+    delay and jitter readout heads sharing the
+    message passing, see std_base_model
+    """
+    heads = ("delay", "jitter")
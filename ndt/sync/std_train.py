@@ -4,9 +4,10 @@ Script for training GNN model as VTwin
 
 import os
 import time
-from typing import List, Optional, Union, Tuple, Dict, Any
+from typing import List, Optional, Union, Tuple, Dict, Any, Sequence
 import tensorflow as tf
 import numpy as np
+from columnar_data import is_columnar, load_dataset, get_columnar_mean_std_dict
 
 # Run eagerly-> Turn true for debugging only
 RUN_EAGERLY = False
@@ -14,6 +15,12 @@ os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 os.environ["CUDA_VISIBLE_DEVICES"] = "0"
 tf.config.run_functions_eagerly(RUN_EAGERLY)
 
+# per-flow labels of the readout heads that are also features of the samples,
+# in the unit of the labels of their own datasets, see generate_data.py
+FEATURE_LABELS = {
+    "jitter": lambda features: features["jitter"][:, 0] * 1000, # ms
+}
+
 
 def get_default_callbacks() -> List[tf.keras.callbacks.Callback]:
     """Returns the default callbacks for the training of the models
@@ -37,23 +44,175 @@ def get_default_callbacks() -> List[tf.keras.callbacks.Callback]:
     ]
 
 
-def get_default_hyperparams() -> Dict[str, Any]:
+def stack_head_labels(ds: tf.data.Dataset, heads: Sequence[str]) -> tf.data.Dataset:
+    """Labels of a dataset with one column per readout head of a multi-head model.
+    The first head predicts the target of the dataset, and takes its labels, and
+    the other heads take theirs from the features, see FEATURE_LABELS. The labels
+    of a single-head model are left as they are.
+
+    Parameters
+    ----------
+    ds : tf.data.Dataset
+        Dataset of (features, labels) samples.
+
+    heads : Sequence[str]
+        Readout heads of the model.
+
+    Returns
+    -------
+    tf.data.Dataset
+        Dataset with the labels of each head stacked in columns.
+    """
+    if len(heads) == 1:
+        return ds
+    for head in heads[1:]:
+        if head not in FEATURE_LABELS:
+            raise ValueError(f"The samples have no labels for the {head} head!")
+
+    def stack_labels(features, labels):
+        return features, tf.stack(
+            [labels] + [FEATURE_LABELS[head](features) for head in heads[1:]], axis=1)
+
+    return ds.map(stack_labels)
+
+
+def _head_error(y_true, y_pred, index,
+                head_loss=tf.keras.losses.mean_absolute_percentage_error):
+    """Per-flow loss of a readout head, on its column of the labels and predictions.
+    The flows with a zero label, which the datasets of the single-head models drop
+    (e.g. a zero jitter), are left out, and the others weighted so their mean over
+    all the flows is the mean over the labeled ones.
+    """
+    y_true, y_pred = y_true[:, index:index + 1], y_pred[:, index:index + 1]
+    labeled = tf.cast(tf.not_equal(y_true[:, 0], 0), y_pred.dtype)
+    scale = tf.cast(tf.size(labeled), y_pred.dtype) / tf.maximum(tf.reduce_sum(labeled), 1)
+
+    return head_loss(y_true, y_pred) * labeled * scale
+
+
+class PerHeadLoss(tf.keras.losses.Loss):
+    """Loss of a multi-head model: the mean over the readout heads of the
+    loss of each head on its own column of the labels, so every head is
+    fitted whatever the scale of its QoS metric
+
+    Parameters
+    ----------
+    heads : Sequence[str]
+        Readout heads of the model, in the order of its output columns.
+
+    head_loss : Callable[[tf.Tensor, tf.Tensor], tf.Tensor], optional
+        Loss of a head, by default the mean absolute percentage error
+    """
+    def __init__(self, heads: Sequence[str],
+                 head_loss=tf.keras.losses.mean_absolute_percentage_error,
+                 name: str = "per_head_loss"):
+        super().__init__(name=name)
+        self.heads = tuple(heads)
+        self.head_loss = head_loss
+
+    def call(self, y_true, y_pred):
+        return tf.add_n([_head_error(y_true, y_pred, i, self.head_loss)
+                         for i in range(len(self.heads))]) / len(self.heads)
+
+
+def get_loss_and_metrics(heads: Optional[Sequence[str]] = None) -> Dict[str, Any]:
+    """Returns the loss and metrics of the training of a model with the given readout
+    heads. A single-head model is fitted with the MeanAbsolutePercentageError, and a
+    multi-head one with the PerHeadLoss, reporting the error of each head as a metric
+    """
+    if heads is None or len(heads) == 1:
+        return {
+            "loss": tf.keras.losses.MeanAbsolutePercentageError(),
+            "metrics": ['MeanAbsolutePercentageError'],
+        }
+    return {
+        "loss": PerHeadLoss(heads),
+        "metrics": [tf.keras.metrics.MeanMetricWrapper(_head_error, name=f"{head}_mape", index=i)
+                    for i, head in enumerate(heads)],
+    }
+
+
+def get_default_hyperparams(heads: Optional[Sequence[str]] = None) -> Dict[str, Any]:
     """Returns the default hyperparameters for the training of the models. That is
     - Adam optimizer with lr=0.001
-    - MeanAbsolutePercentageError loss
+    - MeanAbsolutePercentageError loss, per head for a multi-head model,
+      see get_loss_and_metrics()
     - No additional metrics
     - EarlyStopping and ReduceLROnPlateau callbacks
     - 100 epochs
     """
     return {
         "optimizer": tf.keras.optimizers.Adam(learning_rate=0.001),
-        "loss": tf.keras.losses.MeanAbsolutePercentageError(),
-        "metrics": ['MeanAbsolutePercentageError'],
+        **get_loss_and_metrics(heads),
         "additional_callbacks": get_default_callbacks(),
         "epochs": 50,
     }
 
 
+def get_finetune_callbacks() -> List[tf.keras.callbacks.Callback]:
+    """Returns the callbacks for the fine-tuning of a trained model
+    (EarlyStopping and ReduceLROnPlateau callbacks, with less patience)
+    """
+    return [
+        tf.keras.callbacks.EarlyStopping(
+            monitor="val_loss",
+            patience=3,
+            restore_best_weights=True,
+            min_delta=0.0002,
+        ),
+        tf.keras.callbacks.ReduceLROnPlateau(
+            factor=0.5,
+            patience=2,
+            verbose=0,
+            mode="min",
+            min_delta=0.001,
+        ),
+    ]
+
+
+def get_finetune_hyperparams(heads: Optional[Sequence[str]] = None) -> Dict[str, Any]:
+    """Returns the hyperparameters for the fine-tuning of a trained model. That is
+    - Adam optimizer with lr=0.0001
+    - MeanAbsolutePercentageError loss, per head for a multi-head model,
+      see get_loss_and_metrics()
+    - EarlyStopping and ReduceLROnPlateau callbacks, see get_finetune_callbacks()
+    - 10 epochs
+    """
+    return {
+        "optimizer": tf.keras.optimizers.Adam(learning_rate=0.0001),
+        **get_loss_and_metrics(heads),
+        "additional_callbacks": get_finetune_callbacks(),
+        "epochs": 10,
+    }
+
+
+def freeze_embeddings(model: tf.keras.Model) -> None:
+    """Freeze the flow and link embedding layers of a model, so only the
+    message passing and readout are fine-tuned. The model must be compiled
+    afterwards for it to take effect.
+    """
+    model.flow_embedding.trainable = False
+    model.link_embedding.trainable = False
+
+
+def load_layer_weights(model: tf.keras.Model, weights_file: str) -> None:
+    """Load the layer weights of a trained model, as saved by the ModelCheckpoint
+    of train_and_evaluate(), leaving out the state of the optimizer it was trained with.
+
+    Parameters
+    ----------
+    model : tf.keras.Model
+        Model where to load the weights.
+
+    weights_file : str
+        Path of the model weights, as given to model.load_weights().
+    """
+    model.check_readout_weights(weights_file)
+    layers = {name: value for name, value in vars(model).items()
+              if isinstance(value, tf.keras.layers.Layer)}
+    tf.train.Checkpoint(**layers).restore(weights_file).expect_partial()
+
+
 def get_mean_std_dict(
     ds: tf.data.Dataset, params: List[str], include_y: Optional[str] = None
 ) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
@@ -80,28 +239,48 @@ def get_mean_std_dict(
         The first value is the min value of the parameter, and the second is 1 / (max - min).
     """
 
-    # Use first sample to get the shape of the tensors
-    iter_ds = iter(ds)
-    sample, label = next(iter_ds)
-    params_lists = {param: sample[param].numpy() for param in params}
-    if include_y:
-        params_lists[include_y] = label.numpy()
-
-    # Include the rest of the samples
-    for sample, label in iter_ds:
-        for param in params:
-            params_lists[param] = np.concatenate(
-                (params_lists[param], sample[param].numpy()), axis=0
-            )
+    def get_values(sample, label):
+        values = {param: sample[param] for param in params}
         if include_y:
-            params_lists[include_y] = np.concatenate(
-                (params_lists[include_y], label.numpy()), axis=0
+            values[include_y] = label
+        return values
+
+    def merge_stats(stats, values):
+        # Merge the count, mean and sum of squared deviations of a sample
+        # into the running ones (parallel variance algorithm)
+        new_stats = dict()
+        for param, (count, mean, m2) in stats.items():
+            value = tf.cast(values[param], tf.float64)
+            sample_count = tf.cast(tf.shape(value)[0], tf.float64)
+            sample_mean = tf.math.divide_no_nan(tf.reduce_sum(value, axis=0), sample_count)
+            sample_m2 = tf.reduce_sum(tf.square(value - sample_mean), axis=0)
+            total = count + sample_count
+            delta = sample_mean - mean
+            new_stats[param] = (
+                total,
+                mean + tf.math.divide_no_nan(delta * sample_count, total),
+                m2 + sample_m2 + tf.math.divide_no_nan(delta**2 * count * sample_count, total),
             )
+        return new_stats
+
+    # Use first sample to get the shape of the tensors
+    first_values = get_values(*next(iter(ds)))
+    initial_stats = {
+        param: (
+            tf.constant(0, dtype=tf.float64),
+            tf.zeros(value.shape[1:], dtype=tf.float64),
+            tf.zeros(value.shape[1:], dtype=tf.float64),
+        )
+        for param, value in first_values.items()
+    }
+
+    # Single streaming pass over the dataset, with constant memory
+    stats = ds.map(get_values).reduce(initial_stats, merge_stats)
 
     scores = dict()
-    for param, param_list in params_lists.items():
-        mean_val = np.mean(param_list, axis=0)
-        std_val = np.std(param_list, axis=0)
+    for param, (count, mean, m2) in stats.items():
+        mean_val = mean.numpy().astype(np.float32)
+        std_val = np.sqrt(m2.numpy() / count.numpy()).astype(np.float32)
 
         if all(std_val) == 0:
             scores[param] = [mean_val, std_val]
@@ -111,6 +290,88 @@ def get_mean_std_dict(
     return scores
 
 
+def get_split_mean_std_dict(
+    ds_path: str, params: List[str]
+) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+    """Get the mean-std normalization scores of a dataset split stored on disk.
+    Splits in columnar format are read directly from their columns.
+
+    Parameters
+    ----------
+    ds_path : str
+        Path to the dataset split, either in columnar format or a GZIP tf.data snapshot.
+
+    params : List[str]
+        List of strings indicating the parameters to extract the features from.
+
+    Returns
+    -------
+    Dict[str, Tuple[np.ndarray, np.ndarray]]
+        Dictionary containing the values needed for the mean-std normalization,
+        see get_mean_std_dict().
+    """
+    if is_columnar(ds_path):
+        return get_columnar_mean_std_dict(ds_path, params)
+    return get_mean_std_dict(load_dataset(ds_path), params)
+
+
+def save_mean_std_scores(
+    scores: Dict[str, Tuple[np.ndarray, np.ndarray]], weights_file: str
+) -> None:
+    """Store the mean-std normalization scores of a model in a sidecar
+    file next to its weights, "{weights_file}.mean_std.npz"
+
+    Parameters
+    ----------
+    scores : Dict[str, Tuple[np.ndarray, np.ndarray]]
+        Dictionary containing the values needed for the mean-std normalization,
+        see get_mean_std_dict().
+
+    weights_file : str
+        Path of the model weights, as given to model.load_weights().
+    """
+    sidecar = {}
+    for param, (mean_val, scale_val) in scores.items():
+        sidecar[f"{param}/mean"] = mean_val
+        sidecar[f"{param}/scale"] = scale_val
+
+    os.makedirs(os.path.dirname(weights_file) or ".", exist_ok=True)
+    # write to a temporary file first, so a partial sidecar is never read
+    with open(f"{weights_file}.mean_std.npz.tmp", "wb") as f:
+        np.savez(f, **sidecar)
+    os.replace(f"{weights_file}.mean_std.npz.tmp", f"{weights_file}.mean_std.npz")
+
+
+def load_mean_std_scores(
+    weights_file: str
+) -> Optional[Dict[str, Tuple[np.ndarray, np.ndarray]]]:
+    """Load the mean-std normalization scores stored next to the model weights
+    by save_mean_std_scores()
+
+    Parameters
+    ----------
+    weights_file : str
+        Path of the model weights, as given to model.load_weights().
+
+    Returns
+    -------
+    Optional[Dict[str, Tuple[np.ndarray, np.ndarray]]]
+        Dictionary containing the values needed for the mean-std normalization,
+        or None if the weights have no sidecar file.
+    """
+    if not os.path.isfile(f"{weights_file}.mean_std.npz"):
+        return None
+
+    scores = dict()
+    with np.load(f"{weights_file}.mean_std.npz") as sidecar:
+        for key in sidecar.files:
+            param, value = key.rsplit("/", 1)
+            if value == "mean":
+                scores[param] = [sidecar[f"{param}/mean"], sidecar[f"{param}/scale"]]
+
+    return scores
+
+
 def train_and_evaluate(
     ds_path: Union[str, Tuple[str, str]],
     model: tf.keras.Model,
@@ -124,6 +385,9 @@ def train_and_evaluate(
     topology="unspecified",
     realization=0,
     target="unspecified",
+    compile_model: bool = True,
+    init_weights: Optional[str] = None,
+    frozen_embeddings: bool = False,
 ) -> Tuple[tf.keras.Model, Union[float, np.ndarray, None]]:
     """
     Train the given model with the given dataset, using the provided parameters
@@ -133,7 +397,7 @@ def train_and_evaluate(
     ----------
     ds_path : str
         Path to the dataset. Datasets are expected to be in tf.data.Dataset format, and to 
-        be compressed with GZIP. If ds_path is a string, then it used as the path to both the
+        be compressed with GZIP, or in the columnar format (see columnar_data). If ds_path is a string, then it used as the path to both the
         training and validation dataset. If so, it is expected that the training and
         validation datasets are located in "{ds_path}/training" and "{ds_path}/validation" respectively.
         If ds_path is a tuple of two strings, then the first string is used as the path to the training dataset,
@@ -165,6 +429,21 @@ def train_and_evaluate(
     tensorboard_path : Optional[str], optional
         Path where to store tensorboard logs, by default "{repository root}/tensorboard/{model name}"
 
+    compile_model : bool, optional
+        If False, the model is expected to be compiled already, and the given optimizer,
+        loss and metrics are ignored. The training step traced by a previous training of
+        the model is then reused. By default True
+
+    init_weights : Optional[str], optional
+        Path to the weights of a trained model (e.g. the one in production) to fine-tune,
+        see get_finetune_hyperparams(). The model keeps the mean-std scores stored with
+        them, see save_mean_std_scores(), or computes them from the training dataset if
+        there are none. If None, the model is trained from its initial weights. By default None
+
+    frozen_embeddings : bool, optional
+        If True, the embedding layers are frozen, see freeze_embeddings(). Ignored if
+        compile_model is False. By default False
+
     Returns
     -------
     Tuple[tf.keras.Model, Union[float, np.ndarray, None]]
@@ -173,9 +452,9 @@ def train_and_evaluate(
 
     # Check epoch number is valid
     assert epochs > 0, "Epochs must be greater than 0"
-    # Load ds
-    ds_train = tf.data.Dataset.load(f"{ds_path}/training", compression="GZIP")
-    ds_val = tf.data.Dataset.load(f"{ds_path}/validation", compression="GZIP")
+    # Load ds, with a label column per readout head of the model
+    ds_train = stack_head_labels(load_dataset(f"{ds_path}/training"), model.heads)
+    ds_val = stack_head_labels(load_dataset(f"{ds_path}/validation"), model.heads)
 
     # Checkpoint path
     if ckpt_path is None:
@@ -184,20 +463,40 @@ def train_and_evaluate(
     if tensorboard_path is None:
         tensorboard_path = f"tensorboard/{model.name}"
 
-    # Apply mean-std normalization
-    model.set_mean_std_scores(get_mean_std_dict(ds_train, model.mean_std_scores_fields))
+    # Apply mean-std normalization, keeping the one the weights to
+    # fine-tune were trained with, if stored next to them
+    mean_std_scores = None
+    if init_weights is not None:
+        mean_std_scores = load_mean_std_scores(init_weights)
+    if mean_std_scores is None:
+        mean_std_scores = get_split_mean_std_dict(f"{ds_path}/training",
+                                                  model.mean_std_scores_fields)
+    model.set_mean_std_scores(mean_std_scores)
+    # the checkpoints overwrite the weights at each epoch, so the scores
+    # of a previous training must not be read with them in the meantime
+    weights_file = os.path.join(ckpt_path, f"{target}_final_weight")
+    if os.path.isfile(f"{weights_file}.mean_std.npz"):
+        os.remove(f"{weights_file}.mean_std.npz")
+
+    # Warm start from a trained model
+    if init_weights is not None:
+        model(next(iter(ds_train))[0])
+        load_layer_weights(model, init_weights)
 
     # Compile model
-    model.compile(
-        optimizer=optimizer,
-        loss=loss,
-        metrics=metrics,
-        run_eagerly=RUN_EAGERLY,
-    )
+    if compile_model:
+        if frozen_embeddings:
+            freeze_embeddings(model)
+        model.compile(
+            optimizer=optimizer,
+            loss=loss,
+            metrics=metrics,
+            run_eagerly=RUN_EAGERLY,
+        )
 
     #Create callbacks
     ckpt_callback = tf.keras.callbacks.ModelCheckpoint(
-        filepath=os.path.join(ckpt_path, f"{target}_final_weight"),
+        filepath=weights_file,
         verbose=0,
         mode="min",
         save_best_only=False,
@@ -219,6 +518,8 @@ def train_and_evaluate(
     )
     end_time = time.time()
     print(f"Training time: {end_time - start_time:.2f} seconds")
+    # store the scores with the final weights
+    save_mean_std_scores(mean_std_scores, weights_file)
 
     training_time = np.array([])
     training_time_filename = f"results/{topology}/training_time_{topology}_{target}_r_{realization}.npz"
@@ -233,6 +534,7 @@ if __name__ == "__main__":
     import argparse
     import std_delay_model
     import std_jitter_model
+    import std_delay_jitter_model
 
     parser = argparse.ArgumentParser(
         description="Train a model for flow delay prediction"
@@ -242,6 +544,16 @@ if __name__ == "__main__":
     parser.add_argument("--topology", type=str, required=False)
     parser.add_argument("--realization", type=int, required=False)
     parser.add_argument("--target", type=str, required=False)
+    parser.add_argument("--init-weights", type=str, required=False,
+                        help="Fine-tune the model with these weights instead of training it from scratch")
+    parser.add_argument("--freeze-embeddings", action="store_true", required=False,
+                        help="Freeze the embedding layers when fine-tuning")
+    parser.add_argument("--iterations", type=int, required=False, default=8,
+                        help="Number of message-passing iterations of the model")
+    parser.add_argument("--path-state-dim", type=int, required=False, default=32,
+                        help="Size of the path states of the model")
+    parser.add_argument("--link-state-dim", type=int, required=False, default=32,
+                        help="Size of the link states of the model")
 
     args = parser.parse_args()
 
@@ -253,16 +565,22 @@ if __name__ == "__main__":
         Model = std_delay_model.VirtualTwin
     elif args.target == "jitter":
         Model = std_jitter_model.VirtualTwin
+    elif args.target == "delay_jitter":
+        Model = std_delay_jitter_model.VirtualTwin
     else:
         raise ValueError("Choose a proper QoS predictor model!")
 
     # code for simple training/validation
     train_and_evaluate(
         os.path.join(ds_path),
-        Model(),
-        **get_default_hyperparams(),
+        Model(iterations=args.iterations, path_state_dim=args.path_state_dim,
+              link_state_dim=args.link_state_dim),
+        **(get_default_hyperparams(Model.heads) if args.init_weights is None
+           else get_finetune_hyperparams(Model.heads)),
         ckpt_path=ckpt_path,
         topology=args.topology,
         realization=args.realization,
-        target=args.target
+        target=args.target,
+        init_weights=args.init_weights,
+        frozen_embeddings=args.freeze_embeddings,
     )
@@ -0,0 +1,209 @@
+"""
+Persistent retraining worker of the VTwin, with TensorFlow
+imported and the training step traced before any drift
+"""
+
+import os
+import queue
+import time
+import traceback
+import multiprocessing
+import tensorflow as tf
+from std_train import (train_and_evaluate, get_default_hyperparams, get_finetune_hyperparams,
+                       get_split_mean_std_dict, freeze_embeddings,
+                       stack_head_labels)
+from columnar_data import load_dataset
+import std_delay_model
+import std_jitter_model
+import std_delay_jitter_model
+
+
+def _reset_training_state(model, weights, learning_rate):
+    """
+    Bring a trained model back to its initial weights, and its optimizer
+    to its initial state, keeping the traced training step
+    """
+    model.set_weights(weights)
+    for variable in model.optimizer.variables:
+        variable.assign(tf.zeros_like(variable))
+    model.optimizer.learning_rate = learning_rate
+
+
+def _worker_loop(target, warmup_data, finetune, frozen_embeddings, model_params, jobs, results):
+    """
+    Run the retraining jobs sent by the synchronization loop
+    """
+    try:
+        if target == "delay":
+            model = std_delay_model.VirtualTwin(**model_params)
+        elif target == "jitter":
+            model = std_jitter_model.VirtualTwin(**model_params)
+        elif target == "delay_jitter":
+            model = std_delay_jitter_model.VirtualTwin(**model_params)
+        else:
+            raise ValueError("Choose a proper QoS predictor model!")
+
+        get_hyperparams = get_finetune_hyperparams if finetune else get_default_hyperparams
+        hyperparams = get_hyperparams(model.heads)
+        if finetune and frozen_embeddings:
+            freeze_embeddings(model)
+        model.compile(
+            optimizer=hyperparams["optimizer"],
+            loss=hyperparams["loss"],
+            metrics=hyperparams["metrics"],
+        )
+        learning_rate = float(model.optimizer.learning_rate.numpy())
+
+        # trace the training step with a single batch, so the
+        # first retraining does not pay for it
+        ds_warmup = stack_head_labels(load_dataset(f"{warmup_data}/training"), model.heads).take(1)
+        model.set_mean_std_scores(get_split_mean_std_dict(f"{warmup_data}/training",
+                                                          model.mean_std_scores_fields))
+        model(next(iter(ds_warmup))[0])
+        initial_weights = model.get_weights()
+        model.fit(ds_warmup, validation_data=ds_warmup, epochs=1, verbose=0)
+    except Exception:
+        # the synchronization loop gets the error instead of waiting for a retraining
+        results.put(RuntimeError(f"The retraining worker failed to start:\n{traceback.format_exc()}"))
+        return
+
+    for job in iter(jobs.get, None):
+        # fine-tuning loads the weights to start from, and their mean-std scores
+        init_weights = job["init_weights"] if finetune else None
+        _reset_training_state(model, initial_weights, learning_rate)
+        weights_file = os.path.join(job["ckpt_path"], f"{target}_final_weight")
+        start_time = time.time()
+        try:
+            train_and_evaluate(
+                job["ds_path"],
+                model,
+                **get_hyperparams(model.heads),
+                ckpt_path=job["ckpt_path"],
+                topology=job["topology"],
+                realization=job["realization"],
+                target=target,
+                compile_model=False,
+                init_weights=init_weights,
+            )
+        except Exception:
+            # the worker keeps running, and no new model is notified
+            traceback.print_exc()
+            weights_file = None
+        results.put((job["version"], weights_file, time.time() - start_time))
+
+
+class TrainerWorker:
+    """
+    Long-lived process retraining the VTwin on request. TensorFlow is
+    imported and the training step traced once, when the worker starts,
+    instead of in a new std_train.py process at each drift.
+
+    Parameters
+    ----------
+    target : str
+        QoS metric predicted by the VTwin, delay, jitter or
+        delay_jitter for both, see std_delay_jitter_model.
+
+    warmup_data : str
+        Path to a dataset, with a "training" split, used to trace the training step.
+
+    finetune : bool, optional
+        If True, new model versions are fine-tuned from the weights given with each
+        job, see std_train.get_finetune_hyperparams(). By default False
+
+    frozen_embeddings : bool, optional
+        If True, the embedding layers are frozen when fine-tuning. By default False
+
+    model_params : Optional[Dict[str, Any]], optional
+        Hyperparameters of the VTwin, e.g. its iterations and state
+        dims, see std_base_model.BaseVirtualTwin. By default None
+    """
+    def __init__(self, target, warmup_data, finetune=False, frozen_embeddings=False,
+                 model_params=None):
+        # spawn is used since forking a process with TensorFlow running is unsafe
+        context = multiprocessing.get_context("spawn")
+        self.jobs = context.Queue()
+        self.results = context.Queue()
+        self.process = context.Process(target=_worker_loop,
+                                       args=(target, warmup_data, finetune, frozen_embeddings,
+                                             model_params or {}, self.jobs, self.results),
+                                       daemon=True)
+        self.process.start()
+
+    def submit(self, version, ds_path, ckpt_path, topology="unspecified", realization=0,
+               init_weights=None):
+        """
+        Request the training of a new model version, see std_train.train_and_evaluate().
+        In fine-tuning mode, it starts from init_weights (e.g. the model in production)
+        """
+        self.jobs.put({
+            "version": version,
+            "ds_path": ds_path,
+            "ckpt_path": ckpt_path,
+            "topology": topology,
+            "realization": realization,
+            "init_weights": init_weights,
+        })
+
+    def poll(self):
+        """
+        Get a finished retraining, without blocking
+
+        Returns
+        -------
+        Optional[Tuple[int, str, float]]
+            Version, weights file and training time of the new
+            model, or None if no retraining is over. The weights
+            file is None if the retraining failed.
+
+        Raises
+        ------
+        RuntimeError
+            If the worker failed to start or exited.
+        """
+        try:
+            return self._check(self.results.get_nowait())
+        except queue.Empty:
+            if not self.process.is_alive():
+                return self._check(self._last_result())
+            return None
+
+    def wait(self, timeout=1.0):
+        """
+        Wait for a retraining to finish, see poll(), checking every
+        timeout seconds that the worker is still running
+        """
+        while True:
+            try:
+                return self._check(self.results.get(timeout=timeout))
+            except queue.Empty:
+                if not self.process.is_alive():
+                    return self._check(self._last_result())
+
+    def _last_result(self):
+        """
+        Get the result put by the worker right before it exited, if any
+        """
+        try:
+            return self.results.get(timeout=1.0)
+        except queue.Empty:
+            raise RuntimeError("The retraining worker exited with code "
+                               f"{self.process.exitcode}!") from None
+
+    @staticmethod
+    def _check(result):
+        """
+        Raise the error sent by the worker when it failed to start
+        """
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def close(self):
+        """
+        Stop the worker, after its current job
+        """
+        self.jobs.put(None)
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.kill()